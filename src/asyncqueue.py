@@ -0,0 +1,553 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+'''
+   Date: 10/18/2026
+   Name: asyncqueue
+   Desc: Single threaded, event driven server for the shared queue and the
+   client that stands in for a SyncManager connected to it.  calls are
+   pickled tuples framed by their length
+'''
+
+import asyncore
+
+from os import urandom, getpid
+from hmac import new as hmac, compare_digest
+from hashlib import sha1
+from struct import pack, unpack, calcsize
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from socket import socket, error as SocketError, AF_INET, SOCK_STREAM, IPPROTO_TCP, TCP_NODELAY
+from threading import local
+from collections import deque
+from array import array
+from time import time, sleep
+from Queue import Empty, Full
+from sys import stderr
+from traceback import format_exc
+from atexit import register
+
+HEADER= '!I'
+HEADERSIZE= calcsize(HEADER)
+BUFSIZE= 65536
+
+# bytes of the one frame a client sends before it authenticates, the hmac
+# of the challenge, and the most bytes of any call it sends after
+DIGESTSIZE= sha1().digest_size
+MAXFRAME= 128 * 1024 * 1024
+
+# seconds the server sleeps at most between checks of blocked calls, and
+# of calls waiting on the journal
+POLLINTERVAL= 0.01
+SYNCINTERVAL= 0.001
+
+# seconds the server stops accepting connections for after it fails to
+ACCEPTPAUSE= 0.1
+
+# calls the server answers per target -- everything else is refused
+EXPOSED= dict(
+   pipeline= ('put', 'get', 'qsize', 'qsizes', 'empty', 'putMany', 'getMany', 'waitSize'),
+   store= ('get', 'update', 'pop', '__len__', '__contains__', '__getitem__', '__setitem__', '__delitem__', 'keys', 'has_key'),
+   files= ('setFileContents', 'getFileContents', 'deleteFile')
+)
+
+def rawFrame(data):
+   '''
+   Returns data prefixed by its length
+   '''
+
+   return pack(HEADER, len(data)) + data
+
+def frame(message):
+   '''
+   Returns message pickled and prefixed by its length
+   '''
+
+   return rawFrame(dumps(message, HIGHEST_PROTOCOL))
+
+
+class AsyncHandler(asyncore.dispatcher):
+   '''
+   One client connection.  the first frame is the hmac of the server's
+   challenge, nothing is unpickled before it checks out.  every frame after
+   is a (target, method, args, kwargs) call answered with (True, result)
+   or (False, exception)
+   '''
+
+   def __init__(self, server, sock):
+
+      asyncore.dispatcher.__init__(self, sock, map= server.map)
+
+      self.server= server
+      self.inbuf= []
+      self.inlen= 0
+      self.need= None
+      self.outbuf= deque()
+      self.outpos= 0
+
+      self.challenge= urandom(20)
+      self.authenticated= False
+      self.rejected= False
+      self.send(rawFrame(self.challenge))
+
+   def send(self, data):
+      self.outbuf.append(data)
+
+   def writable(self):
+      return len(self.outbuf) > 0
+
+   def handle_write(self):
+
+      data= self.outbuf[0]
+      self.outpos+= asyncore.dispatcher.send(self, buffer(data, self.outpos, BUFSIZE))
+      if self.outpos >= len(data):
+         self.outbuf.popleft()
+         self.outpos= 0
+
+   def handle_read(self):
+
+      data= self.recv(BUFSIZE)
+      if not data:
+         return
+
+      self.inbuf.append(data)
+      self.inlen+= len(data)
+
+      while not self.rejected:
+
+         if self.need == None:
+            if self.inlen < HEADERSIZE:
+               break
+            data= ''.join(self.inbuf)
+            (self.need, )= unpack(HEADER, data[:HEADERSIZE])
+            self.inbuf= [data[HEADERSIZE:]]
+            self.inlen-= HEADERSIZE
+
+            # nothing is buffered for a frame an unauthenticated client
+            # shouldn't send, or one over the limit
+            if (not self.authenticated and self.need != DIGESTSIZE) or self.need > MAXFRAME:
+               print >> stderr, 'WARNING async queue connection sent a %s byte frame' % (self.need)
+               self.reject()
+               break
+
+         if self.inlen < self.need:
+            break
+
+         data= ''.join(self.inbuf)
+         message= data[:self.need]
+         self.inbuf= [data[self.need:]]
+         self.inlen-= self.need
+         self.need= None
+
+         self.handle_message(message)
+
+   def handle_message(self, message):
+
+      if not self.authenticated:
+         if not compare_digest(message, hmac(self.server.authkey, self.challenge, sha1).digest()):
+            self.reject()
+            return
+
+         self.authenticated= True
+         self.reply(True, None)
+         return
+
+      self.server.dispatch(self, *loads(message))
+
+   def reply(self, ok, result):
+
+      try:
+         self.send(frame((ok, result)))
+      except Exception, e:
+         self.send(frame((False, RuntimeError(str(e)))))
+
+   def reject(self):
+
+      self.rejected= True
+      self.inbuf= []
+      self.inlen= 0
+      self.server.unpark(self)
+      self.close()
+
+   def handle_close(self):
+
+      self.server.unpark(self)
+      self.close()
+
+   def handle_error(self):
+
+      print >> stderr, 'ERROR async queue connection %s' % (format_exc())
+      self.server.unpark(self)
+      self.close()
+
+
+class AsyncServer(asyncore.dispatcher):
+   '''
+   Serves the pipeline, store, file contents and shared queue calls of a
+   SharedQueue from a single thread.  calls which block (waitAny, claim, a
+   blocking putMany and the blocking pipeline get, getMany and waitSize)
+   are parked and answered once they can be.  calls which journal are
+   answered once the journal has synced them, so one fsync commits the
+   calls of every client meanwhile
+   '''
+
+   def __init__(self, sharedQueue, address, authkey, exposed):
+
+      self.map= dict()
+      asyncore.dispatcher.__init__(self, map= self.map)
+
+      self.sharedQueue= sharedQueue
+      self.authkey= authkey
+      self.exposed= dict(EXPOSED, queue= exposed)
+
+      # [(handler, poll, endTime), ...] of blocked calls, and
+      # [(sequence, handler, ok, result), ...] of answers waiting on the
+      # journal
+      self.parked= []
+      self.syncing= []
+
+      # when the server accepts connections again after failing to
+      self.acceptAfter= 0
+      self.sharedQueue.deferSync()
+
+      self.create_socket(AF_INET, SOCK_STREAM)
+      self.set_reuse_addr()
+      self.bind(address)
+      self.listen(128)
+
+   def handle_accept(self):
+
+      pair= self.accept()
+      if pair == None:
+         return
+
+      (sock, address)= pair
+      sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+      AsyncHandler(self, sock)
+
+   def readable(self):
+      return time() >= self.acceptAfter
+
+   def handle_error(self):
+
+      # out of descriptors and the like -- the server keeps listening, after
+      # a pause for connections to close
+      print >> stderr, 'ERROR async queue server %s' % (format_exc())
+      self.acceptAfter= time() + ACCEPTPAUSE
+
+   def target(self, name):
+
+      if name == 'pipeline':
+         return self.sharedQueue.qPipeline
+      elif name == 'store':
+         return self.sharedQueue.qStore
+
+      return self.sharedQueue
+
+   def dispatch(self, handler, target, method, args, kwargs):
+
+      if method not in self.exposed.get(target, ()):
+         handler.reply(False, AttributeError('%s has no exposed method %s' % (target, method)))
+         return
+
+      try:
+         if target == 'queue' and method == 'waitAny':
+            self.parkWaitAny(handler, *args, **kwargs)
+         elif target == 'queue' and method == 'putMany':
+            self.parkPutMany(handler, *args, **kwargs)
+         elif target == 'queue' and method == 'claim':
+            self.parkClaim(handler, *args, **kwargs)
+         elif target == 'pipeline' and method == 'get':
+            self.parkGet(handler, *args, **kwargs)
+         elif target == 'pipeline' and method == 'getMany':
+            self.parkGetMany(handler, *args, **kwargs)
+         elif target == 'pipeline' and method == 'waitSize':
+            self.parkWaitSize(handler, *args, **kwargs)
+         elif target == 'files':
+            self.answer(handler, True, self.files(method, *args, **kwargs))
+         else:
+            self.answer(handler, True, getattr(self.target(target), method)(*args, **kwargs))
+      except Exception, e:
+         self.answer(handler, False, e)
+
+   def answer(self, handler, ok, result):
+      '''
+      Replies to a call, once the operations it journaled are on disk
+      '''
+
+      sequence= self.sharedQueue.journaled()
+      if sequence == None or self.sharedQueue.journal.synced >= sequence:
+         handler.reply(ok, result)
+      else:
+         self.syncing.append((sequence, handler, ok, result))
+
+   def files(self, method, *args, **kwargs):
+      '''
+      Serves the file calls by the SharedQueue methods behind them, the
+      registered handlers of the same names shadow them on the class
+      '''
+
+      if method == 'setFileContents':
+         return self.sharedQueue.writeFile(*args, **kwargs)
+      elif method == 'getFileContents':
+         return self.sharedQueue.readFile(*args, **kwargs).tostring()
+
+      return self.sharedQueue.removeFile(*args, **kwargs)
+
+   def parkWaitAny(self, handler, taskId, cursor= 0, timeout= None):
+
+      def poll():
+         (events, cursor_)= self.sharedQueue.waitAny(taskId, cursor, 0)
+         return (len(events) > 0, (True, (events, cursor_)))
+
+      self.park(handler, poll, timeout)
+
+   def parkPutMany(self, handler, items, block= True, timeout= None):
+
+      def poll():
+         try:
+            return (True, (True, self.sharedQueue.putMany(items, False)))
+         except Full, e:
+            return (not block, (False, e))
+
+      self.park(handler, poll, timeout)
+
+   def parkClaim(self, handler, n, workerId, leaseSeconds, timeout= 0):
+
+      def poll():
+         if self.sharedQueue.qPipeline.qsize() == 0:
+            return (False, (True, []))
+         claimed= self.sharedQueue.claim(n, workerId, leaseSeconds)
+         return (len(claimed) > 0, (True, claimed))
+
+      self.park(handler, poll, timeout)
+
+   def parkGetMany(self, handler, n, timeout= 0):
+
+      def poll():
+         items= self.sharedQueue.qPipeline.getMany(n)
+         return (len(items) > 0, (True, items))
+
+      self.park(handler, poll, timeout)
+
+   def parkWaitSize(self, handler, size, timeout= None):
+
+      def poll():
+         qsize= self.sharedQueue.qPipeline.qsize()
+         return (qsize > size, (True, qsize))
+
+      self.park(handler, poll, timeout)
+
+   def parkGet(self, handler, block= True, timeout= None):
+
+      def poll():
+         try:
+            return (True, (True, self.sharedQueue.qPipeline.get_nowait()))
+         except Empty, e:
+            return (not block, (False, e))
+
+      self.park(handler, poll, timeout)
+
+   def park(self, handler, poll, timeout):
+      '''
+      Answers the call now if poll() says it is ready, otherwise keeps it
+      until it is or its timeout passes
+      '''
+
+      (ready, result)= poll()
+      if ready or timeout == 0:
+         self.answer(handler, *result)
+         return
+
+      endTime= None if timeout == None else time() + timeout
+      self.parked.append((handler, poll, endTime))
+
+   def unpark(self, handler):
+      self.parked= [(parked, poll, endTime) for (parked, poll, endTime) in self.parked if parked != handler]
+      self.syncing= [(sequence, waiting, ok, result) for (sequence, waiting, ok, result) in self.syncing if waiting != handler]
+
+   def checkParked(self):
+
+      if len(self.parked) == 0:
+         return
+
+      currentTime= time()
+      parked= []
+      for (handler, poll, endTime) in self.parked:
+         (ready, result)= poll()
+         if ready or (endTime != None and endTime <= currentTime):
+            self.answer(handler, *result)
+         else:
+            parked.append((handler, poll, endTime))
+
+      self.parked= parked
+
+   def checkSyncing(self):
+
+      if len(self.syncing) == 0:
+         return
+
+      synced= self.sharedQueue.journal.synced
+      syncing= []
+      for (sequence, handler, ok, result) in self.syncing:
+         if sequence <= synced:
+            handler.reply(ok, result)
+         else:
+            syncing.append((sequence, handler, ok, result))
+
+      self.syncing= syncing
+
+   def serve_forever(self):
+      '''
+      Serves calls until the process exits.  poll() rather than select()
+      so any number of connections can be served, and an error serving
+      one pass is logged rather than taking the queue down
+      '''
+
+      while True:
+         if self.syncing:
+            timeout= SYNCINTERVAL
+         elif self.parked:
+            timeout= POLLINTERVAL
+         else:
+            timeout= 1.0
+
+         try:
+            asyncore.loop(timeout= timeout, count= 1, map= self.map, use_poll= True)
+            self.checkParked()
+            self.checkSyncing()
+         except Exception, e:
+            print >> stderr, 'ERROR async queue server %s' % (format_exc())
+            sleep(timeout)
+
+
+class AsyncProxy(object):
+   '''
+   Calls the methods of a target on the server
+   '''
+
+   def __init__(self, manager, target):
+
+      self.manager= manager
+      self.target= target
+
+   def __getattr__(self, method):
+
+      if method.startswith('_'):
+         raise AttributeError(method)
+
+      def call(*args, **kwargs):
+         return self.manager.call(self.target, method, args, kwargs)
+
+      return call
+
+   def __len__(self):
+      return self.manager.call(self.target, '__len__', (), dict())
+
+   def __contains__(self, key):
+      return self.manager.call(self.target, '__contains__', (key, ), dict())
+
+   def __getitem__(self, key):
+      return self.manager.call(self.target, '__getitem__', (key, ), dict())
+
+   def __setitem__(self, key, value):
+      return self.manager.call(self.target, '__setitem__', (key, value), dict())
+
+   def __delitem__(self, key):
+      return self.manager.call(self.target, '__delitem__', (key, ), dict())
+
+
+class AsyncManager(object):
+   '''
+   Stands in for a SyncManager connected to an async queue server.  each
+   thread (and forked process) gets its own connection.  like a
+   SyncManager's proxies, it stops working once the process exits
+   '''
+
+   def __init__(self, address, authkey):
+
+      self.address= address
+      self.authkey= authkey
+      self.connections= local()
+
+      self.closed= False
+      register(self.shutdown)
+
+   def __connection__(self):
+
+      if self.closed:
+         raise EOFError('async queue connection is shutdown')
+
+      sock= getattr(self.connections, 'sock', None)
+      if sock != None and self.connections.pid == getpid():
+         return sock
+
+      sock= socket(AF_INET, SOCK_STREAM)
+      sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+      sock.connect(self.address)
+
+      challenge= self.__read__(sock, unpack(HEADER, self.__read__(sock, HEADERSIZE))[0])
+      sock.sendall(rawFrame(hmac(self.authkey, challenge, sha1).digest()))
+      self.__recv__(sock)
+
+      self.connections.sock= sock
+      self.connections.pid= getpid()
+
+      return sock
+
+   def __recv__(self, sock):
+
+      header= self.__read__(sock, HEADERSIZE)
+      (length, )= unpack(HEADER, header)
+
+      return loads(self.__read__(sock, length))
+
+   def __read__(self, sock, length):
+
+      chunks= []
+      while length > 0:
+         data= sock.recv(min(length, BUFSIZE))
+         if not data:
+            self.connections.sock= None
+            raise EOFError('async queue server closed the connection')
+         chunks.append(data)
+         length-= len(data)
+
+      return ''.join(chunks)
+
+   def connect(self):
+      self.__connection__()
+
+   def shutdown(self):
+      self.closed= True
+
+   def call(self, target, method, args, kwargs):
+
+      sock= self.__connection__()
+      try:
+         sock.sendall(frame((target, method, args, kwargs)))
+         (ok, result)= self.__recv__(sock)
+      except SocketError, e:
+         self.connections.sock= None
+         raise IOError(str(e))
+
+      if not ok:
+         raise result
+
+      return result
+
+   def getPipeline(self):
+      return AsyncProxy(self, 'pipeline')
+
+   def getStore(self):
+      return AsyncProxy(self, 'store')
+
+   def getSharedQueue(self):
+      return AsyncProxy(self, 'queue')
+
+   def setFileContents(self, processId, results):
+      return self.call('files', 'setFileContents', (processId, results), dict())
+
+   def getFileContents(self, processId):
+      return array('c', self.call('files', 'getFileContents', (processId, ), dict()))
+
+   def deleteFile(self, processId):
+      return self.call('files', 'deleteFile', (processId, ), dict())
@@ -84,18 +84,21 @@ class Bot(Task):
 
             self.thread_regulator(current_thread, previous_thread)
 
-            sub_tasks= self.getTask(tag= current_thread.name)
+            # checked before counting what is pending so its last forks are not missed
+            previous_done= previous_thread != None and previous_thread.is_alive() == False
 
-            ready= filter(lambda result: result.get('status') == 'ready', sub_tasks)
-            errors= filter(lambda result: result.get('status') == 'error', sub_tasks)
-          
-            for results in ready:
-               self.ready[current_thread.name].write(dumps(results) + '\n')
-               self.killSubTask(int(results.get('processId').split('.')[1]))
+            ready= []
+            errors= []
+            for results in self.as_completed(tag= current_thread.name, timeout= 0.01):
+
+               if results.get('status') == 'ready':
+                  ready.append(results)
+                  self.ready[current_thread.name].write(dumps(results) + '\n')
+               else:
+                  errors.append(results)
+                  self.errors[current_thread.name].write(dumps(results) + '\n')
 
-            for error in errors:
-               self.errors[current_thread.name].write(dumps(error) + '\n')
-               self.killSubTask(int(error.get('processId').split('.')[1]))
+               self.killSubTask(int(results.get('processId').split('.')[1]))
 
             if len(ready) or len(errors):
                process(self, ready, errors)
@@ -103,7 +106,7 @@ class Bot(Task):
             self.update_counter(current_thread.name, 'processed', len(ready) + len(errors))
             self.show_counter(current_thread)
             
-            if len(sub_tasks) == 0 and previous_thread != None and previous_thread.is_alive() == False:
+            if previous_done and self.countPending(current_thread.name) == 0:
                print "%s %s completed" % (datetime.utcnow(), current_thread.name)
                break
             
@@ -130,14 +133,32 @@ class Bot(Task):
       with self._lock:
          self._current_thread= current_thread
 
-   def forkTask(self, taskCode, taskArgs, processor= None, transport= 'store'):
+   def stage_priority(self, name):
+      '''
+      Later stages get higher priorities so work already in the pipeline
+      drains before new work is started
+      '''
+
+      return [thread.name for thread in self.threads].index(name)
+
+   def forkTask(self, taskCode, taskArgs, processor= None, transport= 'store', priority= None, rateKey= None, retries= 0, backoff= 1.0, taskTimeout= None):
 
       current_thread= currentThread()
       next_thread_name= processor if processor else current_thread.next_thread.name
-      super(Bot, self).forkTask(taskCode, taskArgs, next_thread_name, transport)
+      priority= self.stage_priority(next_thread_name) if priority == None else priority
+      super(Bot, self).forkTask(taskCode, taskArgs, next_thread_name, transport, priority= priority, rateKey= rateKey, retries= retries, backoff= backoff, taskTimeout= taskTimeout)
 
       self.update_counter(current_thread.name, 'forked', 1)
 
+   def forkTasks(self, taskCode, taskArgsList, processor= None, transport= 'store', batchSize= 1000, priority= None, rateKey= None, retries= 0, backoff= 1.0, taskTimeout= None):
+
+      current_thread= currentThread()
+      next_thread_name= processor if processor else current_thread.next_thread.name
+      priority= self.stage_priority(next_thread_name) if priority == None else priority
+      subTaskIds= super(Bot, self).forkTasks(taskCode, taskArgsList, next_thread_name, transport, batchSize, priority, rateKey= rateKey, retries= retries, backoff= backoff, taskTimeout= taskTimeout)
+
+      self.update_counter(current_thread.name, 'forked', len(subTaskIds))
+
    def update_counter(self, name, counter_type, count):
  
       with self._lock:
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+'''
+   Date: 10/18/2026
+   Name: connection
+   Desc: Manager connection helpers shared by the queue, dfs, node and clients
+'''
+
+from socket import fromfd, error as SocketError, AF_INET, SOCK_STREAM, IPPROTO_TCP, TCP_NODELAY
+from multiprocessing import connection
+from multiprocessing.managers import listener_client
+
+SERIALIZER= 'nodelay'
+
+def nodelay(conn):
+   '''
+   Disables Nagle's algorithm on a manager connection.  multiprocessing
+   writes large messages as a separate header and body, which otherwise
+   stalls every batched call on the peer's delayed ack.
+   '''
+
+   try:
+      sock= fromfd(conn.fileno(), AF_INET, SOCK_STREAM)
+      sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+      sock.close()
+   except SocketError:
+      pass
+
+   return conn
+
+
+class Listener(connection.Listener):
+
+   def accept(self):
+      return nodelay(super(Listener, self).accept())
+
+
+def Client(address, family= None, authkey= None):
+   return nodelay(connection.Client(address, family= family, authkey= authkey))
+
+
+listener_client[SERIALIZER]= (Listener, Client)
@@ -21,6 +21,8 @@ from subprocess import Popen
 
 from logger import log
 from daemon import Daemon
+from connection import SERIALIZER
+from shard import Shards
 
 class DFSManager(SyncManager):
    '''
@@ -42,7 +44,7 @@ class DFSManager(SyncManager):
       self.register('getInstances', callable= lambda: self.instances)
       self.dfsInstance= self.opts.dfsInstance
       (self.dfsHost, self.dfsPort, self.dfsKey)= self.opts.dfs.split(':')
-      super(DFSManager, self).__init__(address= (self.dfsHost, int(self.dfsPort)), authkey= self.dfsKey)
+      super(DFSManager, self).__init__(address= (self.dfsHost, int(self.dfsPort)), authkey= self.dfsKey, serializer= SERIALIZER)
 
       # connect to aws ec2
       (
@@ -70,11 +72,16 @@ class DFSManager(SyncManager):
       SyncManager.register('getPipeline')
       SyncManager.register('getStore')
       self.qInstance= self.opts.qInstance
-      (self.qHost, self.qPort, self.qKey)= self.opts.queue.split(':')
-      queue= SyncManager(address= (self.qHost, int(self.qPort)), authkey= self.qKey)
-      queue.connect()
-      self.pipeline= queue.getPipeline()
-      self.store= queue.getStore()
+
+      # the first shard, and what follows its key, :async for an async server
+      address= self.opts.queue.split(',')[0].split(':')
+      (self.qHost, self.qPort, self.qKey)= address[:3]
+      self.qServer= address[3:]
+
+      # queue and store sizes are summed over every shard
+      self.shards= Shards(self.opts.queue)
+      self.pipeline= self.shards.pipeline()
+      self.store= self.shards.store()
 
 
    def getBootStrap(self, filename= None):
@@ -104,11 +111,11 @@ class DFSManager(SyncManager):
                (instance, )= reservation.instances
                dfs= '%s:%s:%s' % (instance.public_dns_name, self.dfsPort, self.dfsKey)
 
-            queue= '%s:%s:%s' % (self.qHost, self.qPort, self.qKey)
-            if self.qInstance != None:
+            queue= self.opts.queue
+            if self.qInstance != None and len(self.shards) == 1:
                (reservation, )= self.ec2Conn.get_all_instances(instance_ids= [self.dfsInstance])
                (instance, )= reservation.instances
-               queue= '%s:%s:%s' % (instance.public_dns_name, self.qPort, self.qKey)
+               queue= ':'.join([instance.public_dns_name, self.qPort, self.qKey] + self.qServer)
              
             log("info", "BOOTSTRAP QUEUE: %s, DFS: %s" % (queue, dfs))
             bootStrap= bootStrap % dict(queue= queue, dfs= dfs, s3= self.opts.s3, maxProcesses= self.opts.maxProcesses, sleep= self.opts.sleep)
@@ -416,7 +423,7 @@ def parseArgs(argv):
    [ optParser.add_option(opt) for opt in [
 
       make_option('-f', '--foreground', action='store_true', dest= 'foreground', default= False, help= 'run in foreground'),
-      make_option('-q', '--queue', default= '0.0.0.0:50001:impetus', help= 'ip:port:key to bind the queue to'),
+      make_option('-q', '--queue', default= '0.0.0.0:50001:impetus', help= 'ip:port:key of the queue, comma separated when the queue is sharded'),
       make_option('-d', '--dfs', default= '0.0.0.0:50002:impetus', help= 'ip:port:key to bind the dfs to'),
       make_option('-D', '--dfsInstance', default= 'i-f4fb929f', help= 'static instance dfs is running on'),
       make_option('-Q', '--qInstance', default= 'i-f4fb929f', help= 'static instance queue is running on'),
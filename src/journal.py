@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+'''
+   Date: 10/18/2026
+   Name: journal
+   Desc: Append-only journal with group commit and snapshot compaction
+   used by the shared queue to recover its state after a restart
+'''
+
+from os import path, makedirs, fsync, remove, rename
+from glob import glob
+from struct import pack, unpack, calcsize
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from threading import Thread, Condition, Lock
+from time import sleep
+
+HEADER= '!I'
+
+class Journal(object):
+   '''
+   Journal of records split into generations.  a snapshot of generation N
+   holds the state before the journal of generation N, so recovery loads the
+   latest snapshot and replays the journals from its generation onwards
+   '''
+
+   def __init__(self, journalDir, syncInterval):
+
+      self.journalDir= journalDir
+      self.syncInterval= syncInterval
+
+      try:
+         makedirs(self.journalDir)
+      except:
+         pass
+
+      self.fh= None
+      self.generation= 0
+
+      # records appended and records known to be on disk
+      self.written= 0
+      self.synced= 0
+      self.lock= Condition()
+      self.syncLock= Lock()
+
+      self.syncer= Thread(target= self.syncJournal)
+      self.syncer.setDaemon(True)
+
+   def __filename__(self, kind, generation):
+      return path.join(self.journalDir, '%s.%010d.%s' % (kind, generation, dict(journal= 'log', snapshot= 'dat').get(kind)))
+
+   def __generations__(self, kind):
+      return sorted([int(path.basename(filename).split('.')[1]) for filename in glob(path.join(self.journalDir, '%s.*.*' % (kind))) if not filename.endswith('.tmp')])
+
+   def __read__(self, filename):
+      '''
+      Reads the records of a journal or snapshot file, stopping at a record
+      torn by a crash
+      '''
+
+      fh= open(filename, 'rb')
+      try:
+         while True:
+            header= fh.read(calcsize(HEADER))
+            if len(header) < calcsize(HEADER):
+               break
+
+            (length, )= unpack(HEADER, header)
+            data= fh.read(length)
+            if len(data) < length:
+               break
+
+            try:
+               record= loads(data)
+            except Exception:
+               break
+
+            yield record
+      finally:
+         fh.close()
+
+   def __write__(self, fh, record):
+
+      data= dumps(record, HIGHEST_PROTOCOL)
+      fh.write(pack(HEADER, len(data)))
+      fh.write(data)
+
+   def recover(self):
+      '''
+      Generates the records of the latest snapshot followed by the records
+      journaled since
+      '''
+
+      snapshots= self.__generations__('snapshot')
+      generation= snapshots[-1] if snapshots else 0
+
+      if snapshots:
+         for record in self.__read__(self.__filename__('snapshot', generation)):
+            yield record
+
+      for journal in self.__generations__('journal'):
+         if journal >= generation:
+            for record in self.__read__(self.__filename__('journal', journal)):
+               yield record
+
+   def start(self):
+      '''
+      Opens a new journal generation for appends and starts the group
+      commit of appended records
+      '''
+
+      generations= self.__generations__('journal') + self.__generations__('snapshot')
+      self.generation= max(generations) + 1 if generations else 0
+      self.fh= open(self.__filename__('journal', self.generation), 'ab')
+
+      self.syncer.start()
+
+   def append(self, record):
+      '''
+      Appends a record to the journal.  returns its sequence number to
+      .wait() on
+      '''
+
+      with self.lock:
+         self.__write__(self.fh, record)
+         self.written+= 1
+         self.lock.notify_all()
+         return self.written
+
+   def wait(self, sequence):
+      '''
+      Waits for the record with the given sequence number to be on disk
+      '''
+
+      with self.lock:
+         while self.synced < sequence:
+            self.lock.wait()
+
+   def syncJournal(self):
+      '''
+      Group commit -- a single fsync makes every record appended since the
+      last one durable
+      '''
+
+      while True:
+
+         with self.lock:
+            while self.synced == self.written:
+               self.lock.wait()
+
+         # let the writers of this group catch up
+         if self.syncInterval > 0:
+            sleep(self.syncInterval)
+
+         with self.syncLock:
+
+            with self.lock:
+               sequence= self.written
+               self.fh.flush()
+
+            fsync(self.fh.fileno())
+
+         with self.lock:
+            self.synced= max(self.synced, sequence)
+            self.lock.notify_all()
+
+   def rotate(self):
+      '''
+      Starts a new journal generation.  returns the new generation, which
+      is the generation a snapshot taken from now on belongs to
+      '''
+
+      with self.syncLock:
+         with self.lock:
+            self.fh.flush()
+            fsync(self.fh.fileno())
+            self.fh.close()
+            self.synced= self.written
+            self.lock.notify_all()
+
+            self.generation+= 1
+            self.fh= open(self.__filename__('journal', self.generation), 'ab')
+
+            return self.generation
+
+   def snapshot(self, generation, records):
+      '''
+      Writes the snapshot records of generation then removes the journals
+      and snapshots it supersedes
+      '''
+
+      filename= self.__filename__('snapshot', generation)
+
+      fh= open(filename + '.tmp', 'wb')
+      for record in records:
+         self.__write__(fh, record)
+      fh.flush()
+      fsync(fh.fileno())
+      fh.close()
+      rename(filename + '.tmp', filename)
+
+      for kind in ('journal', 'snapshot'):
+         for older in self.__generations__(kind):
+            if older < generation:
+               remove(self.__filename__(kind, older))
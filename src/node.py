@@ -11,54 +11,277 @@
 import random
 from uuid import uuid1
 from datetime import datetime
-from os import path, getcwd, pardir, makedirs
+from os import path, getcwd, pardir, makedirs, kill, sysconf, getloadavg
+from resource import getrusage, RUSAGE_SELF
 from sys import exit, argv, stderr, stdout, stdin, exc_info
 from multiprocessing.managers import SyncManager, Process
-from multiprocessing import JoinableQueue
+from multiprocessing import JoinableQueue, RawValue, RawArray, Pipe, cpu_count
 from Queue import Empty
 from optparse import OptionParser, make_option
 from logging import basicConfig
-from time import sleep
+from time import sleep, time
 from socket import getfqdn
 from marshal import loads
 from types import FunctionType
 from traceback import extract_tb
 from atexit import register
+from threading import Thread, Lock, current_thread
+from signal import signal, setitimer, SIGALRM, SIGKILL, ITIMER_REAL
+from thread import get_ident
 from re import search, match, sub, findall
+from collections import OrderedDict
 
 from daemon import Daemon
+from connection import SERIALIZER
 from transports import S3File, FileStore
+from shard import Shards
+
+def residentBytes():
+   '''
+   Returns the resident set size of this process in bytes
+   '''
+
+   try:
+      with open('/proc/self/statm') as fh:
+         return int(fh.read().split()[1]) * sysconf('SC_PAGE_SIZE')
+   except IOError:
+      # peak rather than current size where there is no /proc
+      return getrusage(RUSAGE_SELF).ru_maxrss * 1024
+
+
+def cpuTimes():
+   '''
+   Returns the (busy, total) cpu time of the host so far
+   '''
+
+   with open('/proc/stat') as fh:
+      times= [int(value) for value in fh.readline().split()[1:]]
+
+   # idle and iowait
+   return (sum(times) - sum(times[3:5]), sum(times))
+
+
+class TaskTimeout(Exception):
+   '''
+   Raised in a task which runs over its soft timeout
+   '''
+
+
+class LRUCache(object):
+   '''
+   Thread safe least recently used cache of a bounded size
+   '''
+
+   def __init__(self, size):
+
+      self.size= size
+      self.items= OrderedDict()
+      self.lock= Lock()
+
+   def get(self, key, default= None):
+
+      with self.lock:
+         try:
+            value= self.items.pop(key)
+         except KeyError:
+            return default
+
+         self.items[key]= value
+         return value
+
+   def put(self, key, value):
+
+      with self.lock:
+         self.items.pop(key, None)
+         self.items[key]= value
+         while len(self.items) > self.size:
+            self.items.popitem(last= False)
+
+
+class Resources(object):
+   '''
+   Named resources (eg, http keep-alive connections, db handles) reused by
+   the tasks a worker runs.  task functions get it as the global resources.
+   each slot of the worker has resources of its own, created the first time
+   they are asked for and kept up to size per slot, the least recently used
+   being closed to make room
+   '''
+
+   def __init__(self, size):
+
+      self.size= size
+      self.lock= Lock()
+
+      # thread ident -> OrderedDict of name -> (resource, close)
+      self.slots= dict()
+
+   def __slot__(self):
+
+      with self.lock:
+         return self.slots.setdefault(get_ident(), OrderedDict())
+
+   def __close__(self, name, resource, close):
+
+      try:
+         if close != None:
+            close(resource)
+         elif hasattr(resource, 'close'):
+            resource.close()
+      except Exception, e:
+         print >> stderr, 'WARNING closing resource %s failed %s' % (name, str(e))
+
+   def get(self, name, factory, close= None):
+      '''
+      Returns the resource called name, made by factory() if there isn't
+      one.  it is torn down by close(resource), or its close() method, when
+      evicted or the worker exits
+      '''
+
+      slot= self.__slot__()
+
+      try:
+         (resource, close)= slot.pop(name)
+      except KeyError:
+         resource= factory()
+         while len(slot) >= self.size:
+            (evicted, (evictedResource, evictedClose))= slot.popitem(last= False)
+            self.__close__(evicted, evictedResource, evictedClose)
+
+      slot[name]= (resource, close)
+
+      return resource
+
+   def evict(self, name):
+      '''
+      Closes the resource called name (eg, after it failed) so the next
+      get() makes a new one
+      '''
+
+      slot= self.__slot__()
+      if name in slot:
+         self.__close__(name, *slot.pop(name))
+
+   def close(self):
+      '''
+      Closes the resources of every slot
+      '''
+
+      with self.lock:
+         slots= self.slots.values()
+         self.slots= dict()
+
+      for slot in slots:
+         for (name, (resource, close)) in slot.items():
+            self.__close__(name, resource, close)
+
+
+class Pool(object):
+   '''
+   State the workers of a node share with its manager
+   '''
+
+   def __init__(self, capacity, places):
+
+      # the manager may kill a worker at any point, so nothing here is
+      # shared under a lock.  each worker has a place in the pool and only
+      # writes to its own, which the manager clears once the worker is gone
+
+      # slots of each worker running tasks, and the slots which may run
+      # tasks at a time
+      self.busySlots= RawArray('i', places)
+      self.limit= RawValue('i', capacity)
+
+      # tasks run by each worker, those which errored, the seconds they ran
+      # in total and when the last one started, for the manager's heartbeat
+      # to dfs.  the manager keeps the totals of the workers gone
+      self.done= RawArray('i', places)
+      self.errors= RawArray('i', places)
+      self.taskSeconds= RawArray('d', places)
+      self.lastTask= RawArray('d', places)
+      self.retired= (0, 0, 0.0, 0.0)
+
+      # set to stop the workers
+      self.stopped= RawValue('i', 0)
+
+   def busy(self):
+      return sum(self.busySlots)
+
+   def stats(self):
+      '''
+      Returns the tasks run, those which errored, the seconds they ran and
+      when the last one started, over the workers running and gone
+      '''
+
+      (done, errors, taskSeconds, lastTask)= self.retired
+
+      return (done + sum(self.done), errors + sum(self.errors), taskSeconds + sum(self.taskSeconds), max([lastTask] + list(self.lastTask)))
+
+   def retire(self, place):
+      '''
+      Keeps the stats of a worker which is gone and clears its place for
+      the next worker
+      '''
+
+      (done, errors, taskSeconds, lastTask)= self.retired
+      self.retired= (done + self.done[place], errors + self.errors[place], taskSeconds + self.taskSeconds[place], max(lastTask, self.lastTask[place]))
+
+      self.busySlots[place]= 0
+      self.done[place]= 0
+      self.errors[place]= 0
+      self.taskSeconds[place]= 0.0
+      self.lastTask[place]= 0.0
+
 
 class Worker(Process):
+   '''
+   Worker of the node's pool -- claims and runs tasks over connections it
+   keeps for its lifetime, in as many threads as it has slots.  a persistent
+   worker waits for tasks for as long as the node runs, any other exits once
+   it has been idle for idleSeconds.  either exits once it has run
+   maxTasksPerWorker tasks or grown past maxWorkerRSS, to be replaced
+   '''
    
-   def __init__(self, opts, id, availability):
+   def __init__(self, opts, id, pool, place, persistent):
 
       super(Worker, self).__init__()
       self.opts= opts
       self.id= id
-      self.availability= availability
-
-      self.connect()
-
+      self.pool= pool
+      self.place= place
+      self.persistent= persistent
+
+      # the manager is told of the tasks with a timeout each slot starts
+      # and ends, so it can kill the worker when one runs over, and of the
+      # worker recycling, over a pipe of the worker's own
+      (self.events, self.eventSender)= Pipe(False)
+      self.eventLock= Lock()
+
+      # tasks run by the worker, and set once it is over a recycling limit
+      self.tasksRun= 0
+      self.recycling= False
+
+      # cleared to stop the slots claiming tasks, once they have run those
+      # they claimed the worker stops renewing leases and exits
+      self.claiming= True
       self.alive= True
       self.sleep= self.opts.sleep
 
+      # processIds claimed by this worker which have not completed yet.  the
+      # lock also guards the worker's place in the pool
+      self.leased= set()
+      self.lock= Lock()
+
+      # codeHash -> task function built from the queue's code registry
+      self.handlers= LRUCache(self.opts.codeCacheSize)
+
+      # resources task functions reuse across tasks
+      self.resources= Resources(self.opts.resourceCacheSize)
+
    def connect(self):
-      (qHost, qPort, qKey)= self.opts.queue.split(':')
-      self.queue= SyncManager(address= (qHost, int(qPort)), authkey= qKey)
-      self.queue.connect()
-      self.pipeline= self.queue.getPipeline()
-      self.store= self.queue.getStore()
 
-      # register with DFS
-      self.dfs = None
-      self.instances= dict()
-      if self.opts.dfs != None:
-         SyncManager.register('getInstances')
-         (dHost, dPort, dKey)= self.opts.dfs.split(':')
-         self.dfs= SyncManager(address= (dHost, int(dPort)), authkey= dKey)
-         self.dfs.connect()
-         self.instances= self.dfs.getInstances()
+      # the worker claims from every shard of the queue
+      self.shards= Shards(self.opts.queue)
+      self.sharedQueues= dict([(address, self.shards.connect(address).getSharedQueue()) for address in self.shards.addresses])
 
 
    def handleTransport(self, processId, transport, results):
@@ -90,7 +313,7 @@ class Worker(Process):
       elif transport == 'file' and self.opts.taskDir != None:
 
          try:
-            fileStore= FileStore(proxy= self.queue, processId= processId, mode= 'w')
+            fileStore= FileStore(proxy= self.shards.manager(processId.split('.')[0]), processId= processId, mode= 'w')
             fileStore.write(results)
             results= fileStore.getName()
             fileStore.close()
@@ -105,106 +328,278 @@ class Worker(Process):
       return (transport, results)
 
 
+   def getSharedQueue(self, processId):
+      '''
+      Returns the shared queue of the shard owning processId
+      '''
+
+      (taskId, subTaskId)= processId.split('.')
+      return self.sharedQueues[self.shards.route(taskId)]
+
+   def getHandler(self, codeHash, processId):
+      '''
+      Returns the task function registered under codeHash, building it
+      from the code registry of processId's shard the first time it is seen
+      '''
+
+      handler= self.handlers.get(codeHash)
+      if handler == None:
+
+         code= self.getSharedQueue(processId).getCode(codeHash)
+         if code == None:
+            raise Exception('unknown task code %s' % (codeHash))
+
+         (taskName, taskCode)= code
+         handler= FunctionType(
+            loads(taskCode),
+            dict(globals(), resources= self.resources),
+            taskName
+         )
+         self.handlers.put(codeHash, handler)
+
+      return handler
+
+   def runTask(self, storeData):
+      '''
+      Runs a single claimed task and writes its results back to the store
+      '''
+
+      taskName= storeData.get('taskName')
+      codeHash= storeData.get('codeHash')
+      taskArgs= storeData.get('taskArgs')
+      processId= storeData.get('processId')
+      transport= storeData.get('transport')
+      taskTimeout= storeData.get('taskTimeout')
+
+      print "running task", processId, taskName
+      startTime= time()
+
+      # the soft timeout interrupts the task with an alarm, which only the
+      # main thread gets.  the hard timeout is the manager's to enforce
+      soft= taskTimeout and current_thread().name == 'MainThread'
+      if taskTimeout:
+         self.tell('start', self.pid, get_ident(), processId, time() + taskTimeout + self.opts.timeoutGrace)
+
+      try:
+
+         handler= self.getHandler(codeHash, processId)
+
+         if soft:
+            signal(SIGALRM, self.softTimeout)
+            setitimer(ITIMER_REAL, taskTimeout)
+         try:
+            results= handler(taskArgs)
+         finally:
+            if soft:
+               setitimer(ITIMER_REAL, 0)
+
+         (transport, results)= self.handleTransport(processId, transport, results)
+         status= 'ready'
+
+      except Exception, e:
+         (fileName, lineNum, funcName, statement)= extract_tb(exc_info()[2])[-1]
+         results= {
+            'error': str(e),
+            'taskName': taskName,
+            'lineNum': lineNum,
+            'statement': statement
+         }
+         if isinstance(e, TaskTimeout):
+            results['reason']= 'timeout'
+
+         print >> stderr, 'WARNING', results
+         transport= 'store'
+         status= 'error'
+
+      self.report(startTime, status)
+
+      try:
+         self.getSharedQueue(processId).complete(processId, dict(
+            status= status,
+            results= results,
+            transport= transport
+         ))
+      finally:
+         if taskTimeout:
+            self.tell('end', self.pid, get_ident())
+
+   def report(self, startTime, status):
+      '''
+      Counts a task run in the pool's stats, which the manager sends on to
+      dfs rather than each worker doing so
+      '''
+
+      with self.lock:
+         self.pool.done[self.place]+= 1
+         self.pool.errors[self.place]+= int(status == 'error')
+         self.pool.taskSeconds[self.place]+= time() - startTime
+         self.pool.lastTask[self.place]= max(self.pool.lastTask[self.place], startTime)
+
+   def tell(self, *event):
+      '''
+      Sends the manager an event
+      '''
+
+      with self.eventLock:
+         self.eventSender.send(event)
+
+   def checkRecycle(self):
+      '''
+      Stops the worker once it is over its task count or resident size
+      limit.  it finishes the tasks it has claimed and exits, and the pool
+      replaces it
+      '''
+
+      with self.lock:
+
+         self.tasksRun+= 1
+         if self.recycling:
+            return
+
+         if self.opts.maxTasksPerWorker and self.tasksRun >= self.opts.maxTasksPerWorker:
+            reason= 'tasks'
+         elif self.opts.maxWorkerRSS and residentBytes() >= self.opts.maxWorkerRSS * 1024 * 1024:
+            reason= 'rss'
+         else:
+            return
+
+         self.recycling= True
+
+      print 'recycling worker %s after %s tasks at %0.1fMB' % (self.pid, self.tasksRun, residentBytes() / 1048576.0)
+      self.claiming= False
+      self.tell('recycle', self.pid, reason)
+
+   def softTimeout(self, signum, frame):
+      raise TaskTimeout('task ran over its timeout')
+
+   def heartbeat(self, workerId):
+      '''
+      Keeps the leases on claimed tasks alive while they wait for or are
+      being processed by this worker
+      '''
+
+      while self.alive:
+
+         sleep(self.opts.leaseSeconds / 3.0)
+
+         with self.lock:
+            processIds= list(self.leased)
+
+         shards= dict()
+         for processId in processIds:
+            (taskId, subTaskId)= processId.split('.')
+            shards.setdefault(self.shards.route(taskId), []).append(processId)
+
+         for (address, processIds) in shards.items():
+            try:
+               lost= self.sharedQueues[address].heartbeat(processIds, workerId, self.opts.leaseSeconds)
+               if lost:
+                  print >> stderr, 'WARNING lost leases on', lost
+            except Exception, e:
+               print >> stderr, 'WARNING heartbeat failed %s' % (str(e))
+
    def run(self):
 
       startTime= datetime.now()
+      workerId= '%s:%s' % (self.id, self.pid)
+
+      self.connect()
 
       #ss= random.randint(1, 30)
       #print self.id, "working for", ss
       #sleep(ss)
 
-      while self.alive:
+      heartbeat= Thread(target= self.heartbeat, args= (workerId, ))
+      heartbeat.setDaemon(True)
+      heartbeat.start()
 
-         try:
-            taskId= self.pipeline.get(False)
-            storeData= self.store.get(taskId)
-            if storeData != None:
-
-               status= storeData.get('status')
-               taskName= storeData.get('taskName')
-               taskCode= storeData.get('taskCode')
-               taskArgs= storeData.get('taskArgs')
-               tag= storeData.get('tag')
-               results= storeData.get('results', None)
-               processId= storeData.get('processId')
-               transport= storeData.get('transport')
-
-               self.store.update([(taskId, dict(
-                  status= 'running',
-                  taskName= taskName,
-                  taskCode= taskCode,
-                  taskArgs= taskArgs,
-                  tag= tag,
-                  results= results,
-                  processId= processId,
-                  transport= transport
-               ))])
-
-               self.instances.update([(self.id, dict(
-                  id= self.id,
-                  status= 'running',
-                  capacity= self.opts.maxProcesses,
-                  availability=  self.availability,
-                  lastTask=  datetime.strftime(datetime.utcnow(), '%Y-%m-%dT%H:%M:%S.000Z')
-               ))])
-
-               print "running task", taskId, taskName
-
-               try:
-
-                  handler= FunctionType(
-                     loads(taskCode),
-                     globals(),
-                     taskName
-                  )
-                  results= handler(taskArgs)
-                  (transport, results)= self.handleTransport(processId, transport, results)
-                  status= 'ready'
-
-               except Exception, e:
-                  (fileName, lineNum, funcName, statement)= extract_tb(exc_info()[2])[-1]
-                  results= {
-                     'error': str(e),
-                     'taskName': taskName,
-                     'lineNum': lineNum,
-                     'statement': statement
-                  }
-
-                  print >> stderr, 'WARNING', results
-                  transport= 'store'
-                  status= 'error'
-
-               self.store.update([(taskId, dict(
-                  status= status,
-                  taskName= taskName,
-                  #taskCode= taskCode,
-                  taskArgs= taskArgs,
-                  tag= tag,
-                  results= results,
-                  processId= processId,
-                  transport= transport
-               ))])
+      # each slot claims and runs tasks on its own, so I/O bound tasks run
+      # --threads at a time.  the first slot is the main thread
+      slots= [Thread(target= self.work, args= (workerId, slot)) for slot in range(1, self.opts.threads)]
+      [slot.start() for slot in slots]
+      self.work(workerId, 0)
+      [slot.join() for slot in slots]
 
-            else:
-               print "Could not find data for task %s assuming task killed" % (taskId)
+      # every claimed task has run, their leases need no more renewing
+      self.alive= False
+
+      self.resources.close()
 
-            self.pipeline.task_done()
+      endTime= datetime.now()
+      runTime= endTime - startTime
+
+   def work(self, workerId, slot):
+      '''
+      Claims and runs batches of tasks in a slot of the worker until it stops
+      '''
+
+      # an idle slot waits on one shard at a time, for its share of
+      # claimWait.  the shards turn over with the clock, for every slot at
+      # once, so the slots of the pool wait on different ones
+      position= self.place * self.opts.threads + slot
+      window= self.opts.claimWait / len(self.shards)
+
+      idleSince= time()
+
+      while self.claiming and not self.pool.stopped.value:
+
+         try:
+            # the node's slots are limited by its autotuning
+            if self.pool.busy() >= self.pool.limit.value:
+               sleep(self.sleep)
+               raise Empty
+
+            # claim a batch of tasks -- they come back already marked running
+            currentTime= time()
+            shard= (position + int(currentTime / window)) % len(self.shards)
+
+            claimed= []
+            for i in range(1, len(self.shards) + 1):
+               address= self.shards.addresses[(shard + i) % len(self.shards)]
+
+               # when none of the shards has tasks the slot's shard, tried
+               # last, waits for them until its turn is over
+               claimed= self.sharedQueues[address].claim(self.opts.batchSize, workerId, self.opts.leaseSeconds, window - currentTime % window if i == len(self.shards) else 0)
+               if len(claimed) > 0:
+                  break
+
+            if len(claimed) == 0:
+               raise Empty
+
+            idleSince= time()
+
+            processIds= [storeData.get('processId') for storeData in claimed]
+            with self.lock:
+               self.leased.update(processIds)
+               self.pool.busySlots[self.place]+= 1
+            try:
+               for storeData in claimed:
+                  self.runTask(storeData)
+                  with self.lock:
+                     self.leased.discard(storeData.get('processId'))
+                  self.checkRecycle()
+            finally:
+               # tasks of the batch left unrun, when it failed part way, are
+               # no longer kept alive so they are requeued once their leases
+               # expire
+               with self.lock:
+                  self.leased.difference_update(processIds)
+                  self.pool.busySlots[self.place]-= 1
 
          except Empty:
-            self.alive= False
+            # the worker exits once all its slots are idle
+            with self.lock:
+               idle= self.pool.busySlots[self.place] == 0
+            if not self.persistent and idle and time() - idleSince >= self.opts.idleSeconds:
+               self.claiming= False
          except EOFError:
             self.connect()
          except IOError:
             self.connect()
          except Exception, e:
             print >> stderr, 'ERROR processing task %s' % (str(e))
-            self.alive= False
+            self.claiming= False
 
-         sleep(self.sleep)
-
-      endTime= datetime.now()
-      runTime= endTime - startTime
-      
 
 
 class Manager(object):
@@ -218,6 +613,35 @@ class Manager(object):
       self.alive= True
       self.workers= dict()
 
+      # each worker runs tasks in --threads slots.  autotuning runs the
+      # node at fewer, but no fewer than --minCapacity, starting from there
+      self.capacity= self.opts.maxProcesses * self.opts.threads
+      self.floor= max(1, min(self.opts.minCapacity, self.capacity))
+      self.pool= Pool(self.floor if self.opts.autotune else self.capacity, self.opts.maxProcesses)
+
+      # (pid, slot) -> (processId, hard timeout) of the tasks with a timeout
+      # the workers are running, and the workers recycled by reason, as the
+      # workers tell us
+      self.running= dict()
+      self.recycled= dict(tasks= 0, rss= 0)
+
+      # measurements as of the last autotuning, the limit it increased
+      # from if it did, and whether it is still doubling the limit, which it
+      # does until the node first backs off
+      self.tuned= time()
+      self.tunedDone= 0
+      self.tunedCpu= cpuTimes() if self.opts.autotune else None
+      self.throughput= 0.0
+      self.increasedFrom= None
+      self.slowStart= True
+
+      # the pool's stats as of the last heartbeat to dfs, and the start of
+      # the last task as dfs was told of it
+      self.heartbeatTime= 0
+      self.heartbeatDone= 0
+      self.heartbeatSeconds= 0.0
+      self.lastTask= None
+
       self.connect()
 
       '''
@@ -234,12 +658,12 @@ class Manager(object):
       SyncManager.register('setFileContents')
       SyncManager.register('getFileContents')
       SyncManager.register('deleteFile')
+      SyncManager.register('getSharedQueue')
 
-      (qHost, qPort, qKey)= self.opts.queue.split(':')
-      self.queue= SyncManager(address= (qHost, int(qPort)), authkey= qKey)
-      self.queue.connect()
-      self.pipeline= self.queue.getPipeline()
-      self.store= self.queue.getStore()
+      # queue and store sizes are summed over every shard
+      self.shards= Shards(self.opts.queue)
+      self.pipeline= self.shards.pipeline()
+      self.store= self.shards.store()
 
       # register with dfs
       self.dfs = None
@@ -247,7 +671,7 @@ class Manager(object):
       if self.opts.dfs != None:
          SyncManager.register('getInstances')
          (dHost, dPort, dKey)= self.opts.dfs.split(':')
-         self.dfs= SyncManager(address= (dHost, int(dPort)), authkey= dKey)
+         self.dfs= SyncManager(address= (dHost, int(dPort)), authkey= dKey, serializer= SERIALIZER)
          self.dfs.connect()
          self.instances= self.dfs.getInstances()
 
@@ -256,46 +680,242 @@ class Manager(object):
       while self.alive:
      
          try:  
-            # stop tracking dead workers
-            [self.workers.pop(pid) for (pid, worker) in self.workers.items() if not worker.is_alive()]
+            self.trackEvents()
+            self.killOverruns()
+            self.autotune()
 
-            instanceStore= self.instances.get(self.id, dict())
+            # stop tracking dead workers
+            for (pid, worker) in self.workers.items():
+               if not worker.is_alive():
+                  self.workers.pop(pid)
+                  self.forget(worker)
 
-            # update dfs worker availability
-            availability= self.opts.maxProcesses - len(self.workers) 
-            self.instances.update([(self.id, dict(
-               id= self.id,
-               status= 'running',
-               capacity= self.opts.maxProcesses,
-               availability= availability,
-               lastTask= instanceStore.get('lastTask', datetime.strftime(datetime.utcnow(), '%Y-%m-%dT%H:%M:%S.000Z')
-)
-            ))])
+            # idle slots of the pool, up to its autotuned limit, are available
+            busy= self.pool.busy()
+            limit= self.pool.limit.value
+            availability= max(0, limit - busy)
+            self.heartbeat(limit, availability)
 
             print "========================================================"  
             print "Queue:", self.pipeline.qsize()
+            print "Priorities:", self.pipeline.qsizes()
             print "Store:", len(self.store)
-            print "Capacity:", self.opts.maxProcesses
+            print "Capacity:", limit, "of", self.capacity
             print 'Workers:', len(self.workers)
-            print "Availability:", self.opts.maxProcesses - len(self.workers)
+            print 'Busy:', busy
+            print "Availability:", availability
+            print "Recycled:", self.recycled
+            print "Tasks:", self.pool.stats()[0]
             print "--------------------------------------------------------"  
           
-            # create workers
-            for i in range(min(self.pipeline.qsize(), self.opts.maxProcesses - len(self.workers))):
-               worker= Worker(self.opts, self.id, availability)
-               worker.start()
-               self.workers[worker.pid]= worker
+            # keep the pool's minimum of persistent workers up
+            persistent= len([worker for worker in self.workers.values() if worker.persistent])
+            for i in range(min(self.opts.minProcesses, self.opts.maxProcesses) - persistent):
+               self.spawn(True)
+
+            # grow the pool, up to the workers its limit needs, for the tasks
+            # its idle slots won't get to
+            maxWorkers= (limit + self.opts.threads - 1) // self.opts.threads
+            idle= min(len(self.workers) * self.opts.threads, limit) - busy
+            for i in range(min((self.pipeline.qsize() - idle + self.opts.threads - 1) // self.opts.threads, maxWorkers - len(self.workers))):
+               self.spawn(False)
+
+            # wait on the queue for more tasks than the idle slots will
+            # claim, rather than polling it
+            if len(self.workers) < maxWorkers:
+               self.pipeline.waitSize(min(len(self.workers) * self.opts.threads, limit) - self.pool.busy(), self.sleep)
+            else:
+               sleep(self.sleep)
+
          except EOFError:
             self.connect()
+            sleep(self.sleep)
          except IOError:
             self.connect()
- 
-         sleep(self.sleep)
+            sleep(self.sleep)
 
       # if manager is shutting down -- then wait for workers to finish
       print "manager shutting down"
+      self.pool.stopped.value= 1
       map(lambda (pid, worker): worker.join(), self.workers.items())
 
+   def heartbeat(self, limit, availability):
+      '''
+      Tells dfs of the node's availability and of the tasks its workers ran,
+      at most once every heartbeatInterval
+      '''
+
+      currentTime= time()
+      if currentTime - self.heartbeatTime < self.opts.heartbeatInterval:
+         return
+
+      (done, errors, taskSeconds, lastTask)= self.pool.stats()
+
+      # until the workers run a task, the node's last task is the one dfs
+      # already knows of, if any
+      if lastTask > 0:
+         self.lastTask= datetime.strftime(datetime.utcfromtimestamp(lastTask), '%Y-%m-%dT%H:%M:%S.000Z')
+      elif self.lastTask == None:
+         self.lastTask= self.instances.get(self.id, dict()).get('lastTask', datetime.strftime(datetime.utcnow(), '%Y-%m-%dT%H:%M:%S.000Z'))
+
+      # mean seconds the tasks run since the last heartbeat took
+      tasks= done - self.heartbeatDone
+      meanLatency= (taskSeconds - self.heartbeatSeconds) / tasks if tasks > 0 else 0.0
+
+      self.instances.update([(self.id, dict(
+         id= self.id,
+         status= 'running',
+         capacity= limit,
+         maxCapacity= self.capacity,
+         availability= availability,
+         recycled= dict(self.recycled),
+         lastTask= self.lastTask,
+         tasks= done,
+         errors= errors,
+         meanLatency= meanLatency
+      ))])
+
+      self.heartbeatTime= currentTime
+      self.heartbeatDone= done
+      self.heartbeatSeconds= taskSeconds
+
+   def spawn(self, persistent):
+      '''
+      Starts a worker of the pool
+      '''
+
+      place= min(set(range(self.opts.maxProcesses)) - set([worker.place for worker in self.workers.values()]))
+
+      worker= Worker(self.opts, self.id, self.pool, place, persistent)
+      worker.start()
+      worker.eventSender.close()
+      self.workers[worker.pid]= worker
+
+   def autotune(self):
+      '''
+      Tunes how many slots the node runs at a time between --minCapacity
+      and its capacity every --tuneInterval.  additive increase while
+      tasks wait on busy slots (doubling until the first back off),
+      multiplicative decrease once the cpu or load average is over its
+      target, and an increase which bought no throughput is taken back
+      '''
+
+      currentTime= time()
+      if not self.opts.autotune or currentTime - self.tuned < self.opts.tuneInterval:
+         return
+
+      done= self.pool.stats()[0]
+      throughput= (done - self.tunedDone) / (currentTime - self.tuned)
+
+      (busyCpu, totalCpu)= cpuTimes()
+      cpu= float(busyCpu - self.tunedCpu[0]) / max(1, totalCpu - self.tunedCpu[1])
+      load= getloadavg()[0] / cpu_count()
+
+      current= self.pool.limit.value
+      limit= current
+
+      if cpu > self.opts.maxCpu or load > self.opts.maxLoad:
+         limit= max(self.floor, int(current * 0.75))
+         self.slowStart= False
+      elif self.increasedFrom != None and throughput <= self.throughput:
+         limit= self.increasedFrom
+         self.slowStart= False
+      elif self.pool.busy() >= current and self.pipeline.qsize() > 0:
+         limit= min(self.capacity, current * 2 if self.slowStart else current + self.opts.threads)
+
+      if limit != current:
+         print 'autotuned capacity %s -> %s at %0.1f tasks/s cpu %0.2f load %0.2f' % (current, limit, throughput, cpu, load)
+         self.pool.limit.value= limit
+
+      self.tuned= currentTime
+      self.tunedDone= done
+      self.tunedCpu= (busyCpu, totalCpu)
+      self.throughput= throughput
+      self.increasedFrom= current if limit > current else None
+
+   def trackEvents(self, workers= None):
+      '''
+      Tracks the tasks with a timeout the workers tell us they started and
+      ended, and counts the workers recycled
+      '''
+
+      events= []
+      for worker in (self.workers.values() if workers == None else workers):
+         try:
+            while worker.events.poll():
+               events.append(worker.events.recv())
+         except (EOFError, IOError):
+            # the worker is gone, maybe killed part way through an event
+            pass
+
+      for event in events:
+
+         if event[0] == 'start':
+            (op, pid, slot, processId, hardTimeout)= event
+            self.running[(pid, slot)]= (processId, hardTimeout)
+         elif event[0] == 'end':
+            (op, pid, slot)= event
+            self.running.pop((pid, slot), None)
+         elif event[0] == 'recycle':
+            (op, pid, reason)= event
+            self.recycled[reason]+= 1
+
+   def forget(self, worker):
+      '''
+      Stops tracking the tasks of a worker which is gone and gives its
+      place in the pool, and the slots it held busy, to the next worker
+      '''
+
+      self.trackEvents([worker])
+      worker.events.close()
+
+      for (pid, slot) in self.running.keys():
+         if pid == worker.pid:
+            self.running.pop((pid, slot))
+
+      self.pool.retire(worker.place)
+
+   def killOverruns(self):
+      '''
+      Kills the workers with a task running past its hard timeout and
+      records their tasks past it as errors, so their slots come back to the
+      pool right away.  the other tasks the worker had claimed are requeued
+      once their leases expire
+      '''
+
+      currentTime= time()
+      for ((pid, slot), (processId, hardTimeout)) in self.running.items():
+
+         if hardTimeout > currentTime or pid not in self.workers:
+            continue
+
+         print >> stderr, 'WARNING killing worker %s running %s past its timeout' % (pid, processId)
+         worker= self.workers.pop(pid)
+         try:
+            kill(pid, SIGKILL)
+         except OSError:
+            pass
+         worker.join()
+
+         # the worker's tasks may have ended while we got to it, those which
+         # haven't and are past their timeout are errors
+         self.trackEvents([worker])
+         for ((runningPid, slot), (processId, hardTimeout)) in self.running.items():
+            if runningPid != pid or hardTimeout > currentTime:
+               continue
+            (taskId, subTaskId)= processId.split('.')
+            self.shards.manager(taskId).getSharedQueue().complete(processId, dict(
+               status= 'error',
+               results= {
+                  'error': 'task ran over its timeout and was killed',
+                  'reason': 'timeout',
+                  'workerId': '%s:%s' % (self.id, pid)
+               },
+               transport= 'store'
+            ))
+
+         self.forget(worker)
+
    def stop(self):
 
       print "de-registering with dfs -- all workers down"
@@ -350,14 +970,31 @@ def parseArgs(argv):
 
    [ optParser.add_option(opt) for opt in [
       make_option('-f', '--foreground', action='store_true', dest= 'foreground', default= False, help= 'run in foreground'),
-      make_option('-q', '--queue', default= 'localhost:50001:impetus', help= 'queue ip:port:key'),
+      make_option('-q', '--queue', default= 'localhost:50001:impetus', help= 'queue ip:port:key, comma separated when the queue is sharded'),
       make_option('-d', '--dfs', default= 'localhost:50002:impetus', help= 'dfs ip:port:key'),
       make_option('-s', '--s3', default= None, help= '<accessKey>:<secretKey>:<bucket> for s3 transport'),
       make_option('-p', '--pidDir', default= path.join(getcwd(), '../pid'), help= 'path to pid directory'),
       make_option('-o', '--logDir', default= path.join(getcwd(), '../log'), help= 'path to log directory'),
       make_option('-t', '--taskDir', default= path.join(getcwd(), '../tasks'), help= 'path to task directory'),
-      make_option('-m', '--maxProcesses', default= 25, type= int, help= 'path to pid directory'),
-      make_option('-n', '--sleep', default= 0.01, type= float, help= 'sleep time for waits')
+      make_option('-m', '--maxProcesses', default= 25, type= int, help= 'most workers in the pool'),
+      make_option('-T', '--threads', default= 1, type= int, help= 'tasks each worker runs at a time in threads, for I/O bound tasks'),
+      make_option('-M', '--minProcesses', default= 1, type= int, help= 'workers kept in the pool while idle'),
+      make_option('-i', '--idleSeconds', default= 30, type= float, help= 'seconds a worker beyond the minimum waits for tasks before exiting'),
+      make_option('-n', '--sleep', default= 1.0, type= float, help= 'most seconds the manager waits on the queue between checks of its workers'),
+      make_option('-w', '--claimWait', default= 5.0, type= float, help= 'seconds an idle worker waits on the queue for tasks per claim, split over its shards'),
+      make_option('-b', '--batchSize', default= 10, type= int, help= 'number of tasks a worker claims per call'),
+      make_option('-l', '--leaseSeconds', default= 300, type= int, help= 'seconds a claimed task is leased to a worker'),
+      make_option('-c', '--codeCacheSize', default= 128, type= int, help= 'number of task functions a worker keeps built'),
+      make_option('-g', '--timeoutGrace', default= 10, type= float, help= 'seconds past its timeout a task is killed in, along with its worker'),
+      make_option('-A', '--autotune', action= 'store_true', default= False, help= 'tune the slots the node runs at a time to its throughput, cpu and load'),
+      make_option('-F', '--minCapacity', default= 1, type= int, help= 'fewest slots autotuning runs the node at'),
+      make_option('-u', '--tuneInterval', default= 10, type= float, help= 'seconds between autotunings'),
+      make_option('-U', '--maxCpu', default= 0.9, type= float, help= 'cpu utilisation autotuning backs off above'),
+      make_option('-L', '--maxLoad', default= 1.5, type= float, help= 'load average per cpu autotuning backs off above'),
+      make_option('-k', '--maxTasksPerWorker', default= 0, type= int, help= 'tasks a worker runs before it is replaced, 0 for unlimited'),
+      make_option('-R', '--maxWorkerRSS', default= 0, type= float, help= 'resident MB a worker grows to before it is replaced, 0 for unlimited'),
+      make_option('-r', '--resourceCacheSize', default= 16, type= int, help= 'number of resources a worker keeps open per slot'),
+      make_option('-H', '--heartbeatInterval', default= 5, type= float, help= 'seconds between updates of the node\'s availability and task counts to dfs')
    ]]
 
    optParser.set_usage('%%prog %s' % ('|'.join(opt_args)))
@@ -8,42 +8,701 @@
 '''
 
 from datetime import datetime
+from time import time, sleep
+from math import ceil
+from random import uniform
+from threading import Thread, Condition, RLock, Lock as ThreadLock, local
+from itertools import islice, count
+from collections import OrderedDict, deque
+from sqlite3 import connect, Binary
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
 from glob import glob
 from os import path, getcwd, pardir, makedirs, remove
 from sys import exit, argv, stderr, stdout, stdin
 from multiprocessing.managers import SyncManager, DictProxy, Value, Array
-from multiprocessing import JoinableQueue, Lock
+from multiprocessing import Lock
+from Queue import Queue as ThreadQueue, Full, Empty
+from heapq import heappush, heappop, heapify
 from optparse import OptionParser, make_option
 from logging import basicConfig
 
 from daemon import Daemon
+from journal import Journal
+from connection import SERIALIZER
+from asyncqueue import AsyncServer
+
+# methods of the shared queue exposed to clients
+EXPOSED= (
+   'putMany',
+   'depth',
+   'claim',
+   'heartbeat',
+   'complete',
+   'waitAny',
+   'clearCompletions',
+   'getStatuses',
+   'getMany',
+   'getByTag',
+   'countByTag',
+   'pop',
+   'registerCode',
+   'getCode',
+   'setRateLimit',
+)
 
 class MemcacheStore(DictProxy):
+   '''
+   Store kept in memcached.  each manager thread talks over its own client
+   and the keys of each task are tracked here, so the length of the store
+   isn't thrown off by anyone else sharing the memcached
+   '''
+
+   def __init__(self, host, port, compressLen):
 
-   def __init__(self, host, port):
       from memcache import Client
-      self.mc= Client(['%s:%s' % (host, port)])
+
+      self.Client= Client
+      self.servers= ['%s:%s' % (host, port)]
+      self.compressLen= compressLen
+      self.clients= local()
+
+      # taskId -> set(processIds) in the store
+      self.keys= dict()
+      self.lock= ThreadLock()
+
+   def __client__(self):
+
+      client= getattr(self.clients, 'client', None)
+      if client == None:
+         client= self.clients.client= self.Client(self.servers)
+
+      return client
+
+   def __track__(self, processIds):
+
+      with self.lock:
+         for processId in processIds:
+            (taskId, subTaskId)= processId.split('.')
+            self.keys.setdefault(taskId, set()).add(processId)
+
+   def __untrack__(self, processId):
+
+      (taskId, subTaskId)= processId.split('.')
+      with self.lock:
+         processIds= self.keys.get(taskId, set())
+         processIds.discard(processId)
+         if len(processIds) == 0:
+            self.keys.pop(taskId, None)
 
    def update(self, updates):
-      for update in updates:
-         (processId, data)= update
-         self.mc.set(processId, data)
+
+      updates= dict(updates)
+      if len(updates) == 0:
+         return
+
+      failed= self.__client__().set_multi(updates, min_compress_len= self.compressLen)
+      self.__track__([processId for processId in updates if processId not in failed])
+
+      if failed:
+         raise IOError('memcache failed to store %s entries' % (len(failed)))
 
    def get(self, processId, default= None):
-      data= self.mc.get(processId)
+
+      data= self.__client__().get(processId)
       if data == None:
          return default
+
       return data
 
+   def getMany(self, processIds):
+      '''
+      Returns the entry of each of the processIds in a single round trip
+      '''
+
+      found= self.__client__().get_multi(processIds)
+
+      return [found.get(processId) for processId in processIds]
+
    def pop(self, processId):
-      data= self.mc.get(processId)
-      self.mc.delete(processId)
-      return data
+
+      client= self.__client__()
+
+      data= client.get(processId)
       if data == None:
-         return default
+         raise KeyError(processId)
+
+      client.delete(processId)
+      self.__untrack__(processId)
+
+      return data
+
+   def __contains__(self, processId):
+
+      (taskId, subTaskId)= processId.split('.')
+      with self.lock:
+         return processId in self.keys.get(taskId, ())
 
    def __len__(self):
-      return int(self.mc.get_stats()[0][1].get('curr_items'))
+
+      with self.lock:
+         return sum([len(processIds) for processIds in self.keys.values()])
+
+   def chunks(self, size):
+      '''
+      Generates the entries of the store in lists of up to size entries
+      '''
+
+      with self.lock:
+         processIds= [processId for processIds in self.keys.values() for processId in processIds]
+
+      for i in xrange(0, len(processIds), size):
+         found= self.__client__().get_multi(processIds[i:i + size])
+         yield found.items()
+
+
+class SqliteStore(DictProxy):
+   '''
+   Store kept on disk in sqlite behind a write-back LRU cache, so the
+   number of entries is bounded by disk rather than by the queue's memory
+   '''
+
+   def __init__(self, filename, cacheSize):
+
+      self.cacheSize= cacheSize
+      self.cache= OrderedDict()
+      self.dirty= set()
+      self.lock= RLock()
+
+      self.db= connect(filename, check_same_thread= False, isolation_level= None)
+      self.db.execute('PRAGMA synchronous= OFF')
+      self.db.execute('PRAGMA journal_mode= MEMORY')
+      self.db.execute('CREATE TABLE IF NOT EXISTS store (processId TEXT PRIMARY KEY, data BLOB)')
+
+      # the store starts out empty like the dict store does
+      self.db.execute('DELETE FROM store')
+      self.count= 0
+
+   def __load__(self, processId):
+
+      row= self.db.execute('SELECT data FROM store WHERE processId= ?', (processId, )).fetchone()
+      if row == None:
+         return None
+
+      return loads(str(row[0]))
+
+   def __evict__(self):
+
+      if len(self.cache) <= self.cacheSize:
+         return
+
+      # evict down to 90% of the cache in one go so writes are batched
+      writes= []
+      while len(self.cache) > self.cacheSize * 0.9:
+         (processId, data)= self.cache.popitem(last= False)
+         if processId in self.dirty:
+            self.dirty.discard(processId)
+            writes.append((processId, Binary(dumps(data, HIGHEST_PROTOCOL))))
+
+      self.__write__(writes)
+
+   def __write__(self, writes):
+
+      self.db.execute('BEGIN')
+      self.db.executemany('INSERT OR REPLACE INTO store (processId, data) VALUES (?, ?)', writes)
+      self.db.execute('COMMIT')
+
+   def update(self, updates):
+
+      with self.lock:
+         for (processId, data) in updates:
+            if processId not in self.cache and self.db.execute('SELECT 1 FROM store WHERE processId= ?', (processId, )).fetchone() == None:
+               self.count+= 1
+            self.cache.pop(processId, None)
+            self.cache[processId]= data
+            self.dirty.add(processId)
+
+         self.__evict__()
+
+   def get(self, processId, default= None):
+
+      with self.lock:
+
+         data= self.cache.pop(processId, None)
+         if data == None:
+            data= self.__load__(processId)
+            if data == None:
+               return default
+
+         self.cache[processId]= data
+         self.__evict__()
+
+      return data
+
+   def getMany(self, processIds):
+      '''
+      Returns the entry of each of the processIds
+      '''
+
+      with self.lock:
+         return [self.get(processId) for processId in processIds]
+
+   def pop(self, processId):
+
+      with self.lock:
+
+         data= self.cache.pop(processId, None)
+         self.dirty.discard(processId)
+         if data == None:
+            data= self.__load__(processId)
+
+         if data == None:
+            raise KeyError(processId)
+
+         self.db.execute('DELETE FROM store WHERE processId= ?', (processId, ))
+         self.count-= 1
+
+      return data
+
+   def __contains__(self, processId):
+      return self.get(processId) != None
+
+   def __len__(self):
+      return self.count
+
+   def chunks(self, size):
+      '''
+      Generates the entries of the store in lists of up to size entries
+      '''
+
+      processId= ''
+      while True:
+
+         with self.lock:
+            self.sync()
+            rows= self.db.execute('SELECT processId, data FROM store WHERE processId > ? ORDER BY processId LIMIT ?', (processId, size)).fetchall()
+
+         if len(rows) == 0:
+            break
+
+         yield [(str(processId), loads(str(data))) for (processId, data) in rows]
+         processId= rows[-1][0]
+
+   def sync(self):
+      '''
+      Writes every dirty cached entry to disk
+      '''
+
+      with self.lock:
+         writes= [(processId, Binary(dumps(self.cache[processId], HIGHEST_PROTOCOL))) for processId in self.dirty]
+         self.__write__(writes)
+         self.dirty.clear()
+
+
+class TokenBucket(object):
+   '''
+   Token bucket refilled at rate tokens a second up to burst tokens
+   '''
+
+   def __init__(self, rate, burst, currentTime):
+
+      self.rate= rate
+      self.burst= burst
+      self.tokens= burst
+      self.updated= currentTime
+
+   def take(self, currentTime):
+      '''
+      Takes a token.  returns 0 if there was one, otherwise the seconds
+      until there will be
+      '''
+
+      self.tokens= min(self.burst, self.tokens + (currentTime - self.updated) * self.rate)
+      self.updated= currentTime
+
+      if self.tokens >= 1:
+         self.tokens-= 1
+         return 0
+
+      return (1 - self.tokens) / self.rate
+
+
+class Pipeline(ThreadQueue):
+   '''
+   Thread safe pipeline of processIds living inside the shared queue server.
+   processIds are queued as (processId, priority, tag, rateKey) into a FIFO
+   sub-queue per priority, tag and rateKey.  the sub-queues are dequeued
+   weighted fair: each gets a share of 2 ** priority, so no tag starves
+   another of the same priority and higher priorities drain faster without
+   starving lower ones.  a sub-queue whose rateKey has used up its token
+   bucket is set aside until its next token, leaving the other sub-queues
+   to be dequeued
+   '''
+
+   def __init__(self, rateLimit= 0, rateBurst= 1):
+
+      # default tokens a second and bucket size of each rateKey, 0 for unlimited
+      self.rateLimit= rateLimit
+      self.rateBurst= rateBurst
+
+      ThreadQueue.__init__(self)
+
+   def _init(self, maxsize):
+
+      # (priority, tag, rateKey) -> deque of processIds
+      self.queues= dict()
+
+      # heap of (virtual finish time, -priority, sequence, (priority, tag, rateKey))
+      # over the non-empty sub-queues
+      self.schedule= []
+      self.sequence= count()
+      self.virtualTime= 0.0
+
+      self.count= 0
+      self.priorities= dict()
+
+      # rateKey -> TokenBucket, and rateKey -> (rate, burst) set by .setRate()
+      self.buckets= dict()
+      self.rates= dict()
+
+      # heap of (time of next token, sequence, (priority, tag, rateKey)) over
+      # the non-empty sub-queues set aside for their rateKey
+      self.throttles= []
+      self.throttledKeys= set()
+      self.throttledCount= 0
+
+      # (endTime, lock) of the calls blocked in .getMany() and in .waitSize().
+      # each waits on its own lock, released once it has something to check
+      # or by .release() once its endTime passes, so idle waiters cost nothing
+      self.waiters= deque()
+      self.watchers= deque()
+
+   def _qsize(self, len= len):
+
+      self.__release__(time())
+      return self.count - self.throttledCount
+
+   def _put(self, item):
+
+      # a bare processId goes on the default sub-queue
+      if not isinstance(item, tuple):
+         item= (item, 0, None, None)
+      elif len(item) == 3:
+         item= item + (None, )
+
+      (processId, priority, tag, rateKey)= item
+      key= (priority, tag, rateKey)
+      queue= self.queues.get(key)
+      if queue == None:
+         queue= self.queues[key]= deque()
+         heappush(self.schedule, (self.virtualTime, -priority, next(self.sequence), key))
+      elif key in self.throttledKeys:
+         self.throttledCount+= 1
+
+      queue.append(processId)
+      self.count+= 1
+      self.priorities[priority]= self.priorities.get(priority, 0) + 1
+
+      self.__wake__(1)
+
+   def _get(self):
+
+      processId= self.__pop__(time())
+      if processId == None:
+         raise Empty('every waiting processId is rate limited')
+
+      return processId
+
+   def __take__(self, rateKey, currentTime):
+      '''
+      Takes a token of rateKey.  returns 0 if there was one, otherwise the
+      seconds until there will be
+      '''
+
+      if rateKey == None:
+         return 0
+
+      bucket= self.buckets.get(rateKey)
+      if bucket == None:
+         (rate, burst)= self.rates.get(rateKey, (self.rateLimit, self.rateBurst))
+         if rate <= 0:
+            return 0
+         bucket= self.buckets[rateKey]= TokenBucket(rate, burst, currentTime)
+
+      return bucket.take(currentTime)
+
+   def __pop__(self, currentTime):
+      '''
+      Pops the next processId whose rateKey has a token, setting aside the
+      sub-queues met along the way whose rateKey has none.  returns None
+      once every non-empty sub-queue is set aside
+      '''
+
+      while self.schedule:
+
+         (virtualTime, order, sequence, key)= heappop(self.schedule)
+         self.virtualTime= virtualTime
+
+         (priority, tag, rateKey)= key
+         queue= self.queues[key]
+
+         wait= self.__take__(rateKey, currentTime)
+         if wait > 0:
+            heappush(self.throttles, (currentTime + wait, next(self.sequence), key))
+            self.throttledKeys.add(key)
+            self.throttledCount+= len(queue)
+            continue
+
+         processId= queue.popleft()
+         if len(queue) > 0:
+            heappush(self.schedule, (virtualTime + 1.0 / 2 ** priority, -priority, next(self.sequence), key))
+         else:
+            self.queues.pop(key)
+
+         self.count-= 1
+         self.priorities[priority]-= 1
+         if self.priorities[priority] == 0:
+            self.priorities.pop(priority)
+
+         return processId
+
+      return None
+
+   def __release__(self, currentTime):
+      '''
+      Puts the sub-queues set aside whose next token is due back on the
+      schedule.  returns how many were
+      '''
+
+      released= 0
+      while self.throttles and self.throttles[0][0] <= currentTime:
+
+         (readyTime, sequence, key)= heappop(self.throttles)
+         self.throttledKeys.discard(key)
+         self.throttledCount-= len(self.queues[key])
+         heappush(self.schedule, (self.virtualTime, -key[0], next(self.sequence), key))
+         released+= 1
+
+      return released
+
+   def __wait__(self, waiters, endTime):
+      '''
+      Waits, with the mutex held, to be woken by .__wake__() or, once endTime
+      passes, by .release()
+      '''
+
+      waiter= ThreadLock()
+      waiter.acquire()
+      waiters.append((endTime, waiter))
+
+      self.mutex.release()
+      try:
+         waiter.acquire()
+      finally:
+         self.mutex.acquire()
+
+   def __wake__(self, n):
+      '''
+      Wakes n of the blocked .getMany() calls and every blocked .waitSize()
+      '''
+
+      for i in xrange(min(n, len(self.waiters))):
+         self.waiters.popleft()[1].release()
+
+      while self.watchers:
+         self.watchers.popleft()[1].release()
+
+   def release(self):
+      '''
+      Wakes the consumers waiting on sub-queues whose rateKey has a token
+      again, and the blocked calls whose timeout has passed
+      '''
+
+      with self.not_empty:
+
+         currentTime= time()
+         released= self.__release__(currentTime)
+         if released:
+            self.not_empty.notify(released)
+            self.__wake__(released)
+
+         for waiters in (self.waiters, self.watchers):
+            expired= [(endTime, waiter) for (endTime, waiter) in waiters if endTime != None and endTime <= currentTime]
+            if expired:
+               waiting= [(endTime, waiter) for (endTime, waiter) in waiters if endTime == None or endTime > currentTime]
+               waiters.clear()
+               waiters.extend(waiting)
+               for (endTime, waiter) in expired:
+                  waiter.release()
+
+   def setRate(self, rateKey, rate, burst):
+      '''
+      Limits the processIds of rateKey dequeued to rate a second with
+      bursts of up to burst, 0 for unlimited
+      '''
+
+      with self.mutex:
+
+         self.rates[rateKey]= (rate, burst)
+         self.buckets.pop(rateKey, None)
+
+         # sub-queues set aside under the old rate are reconsidered
+         self.throttles= [(0 if key[2] == rateKey else readyTime, sequence, key) for (readyTime, sequence, key) in self.throttles]
+         heapify(self.throttles)
+
+      self.release()
+
+   def waitSize(self, size, timeout= None):
+      '''
+      Waits for up to timeout seconds for more than size items to be ready
+      to pop off the pipeline.  returns how many are
+      '''
+
+      endTime= None if timeout == None else time() + timeout
+
+      with self.mutex:
+         while self._qsize() <= size and (endTime == None or time() < endTime):
+            self.__wait__(self.watchers, endTime)
+
+         return self._qsize()
+
+   def throttled(self):
+      '''
+      Returns the number of processIds waiting for their rateKey's token
+      '''
+
+      with self.mutex:
+         self.__release__(time())
+         return self.throttledCount
+
+   def qsizes(self):
+      '''
+      Returns the number of processIds waiting at each priority, including
+      those waiting for their rateKey's token
+      '''
+
+      with self.mutex:
+         return dict(self.priorities)
+
+   def putMany(self, items):
+      '''
+      Puts a batch of items on the pipeline under a single lock acquisition
+      '''
+
+      with self.not_full:
+         for item in items:
+            self._put(item)
+         self.unfinished_tasks+= len(items)
+         self.not_empty.notify(len(items))
+
+   def items(self):
+      '''
+      Returns a copy of the items waiting on the pipeline in order
+      '''
+
+      with self.mutex:
+         keys= [key for (virtualTime, order, sequence, key) in sorted(self.schedule)] + [key for (readyTime, sequence, key) in sorted(self.throttles)]
+         return [processId for key in keys for processId in self.queues[key]]
+
+   def getMany(self, n, timeout= 0):
+      '''
+      Pops up to n items off the pipeline, skipping over those whose rateKey
+      is out of tokens.  while there are none it waits for up to timeout
+      seconds, None to wait for as long as it takes.  items handed out this
+      way are accounted as done, their leases track them from here
+      '''
+
+      endTime= None if timeout == None else time() + timeout
+
+      with self.not_empty:
+
+         items= []
+         while True:
+
+            currentTime= time()
+            self.__release__(currentTime)
+
+            while len(items) < n:
+               processId= self.__pop__(currentTime)
+               if processId == None:
+                  break
+               items.append(processId)
+
+            if items or (endTime != None and currentTime >= endTime):
+               break
+
+            self.__wait__(self.waiters, endTime)
+
+         if items:
+            self.unfinished_tasks-= len(items)
+            if self.unfinished_tasks <= 0:
+               self.all_tasks_done.notify_all()
+            self.not_full.notify(len(items))
+
+      return items
+
+
+class TimerWheel(object):
+   '''
+   Hashed timer wheel of items to release at a given time.  items are kept
+   in a bucket per tick, so adding one is O(1) and it is touched once more
+   when its tick comes around -- there is no thread or rescan per item
+   '''
+
+   def __init__(self, tickSeconds):
+
+      self.tickSeconds= tickSeconds
+      self.buckets= dict()
+      self.count= 0
+      self.lock= ThreadLock()
+
+      # last tick released
+      self.tick= int(time() / self.tickSeconds)
+
+   def __len__(self):
+      return self.count
+
+   def addMany(self, timers):
+      '''
+      Adds (runAt, item) timers, items are released no earlier than runAt
+      '''
+
+      with self.lock:
+         for (runAt, item) in timers:
+            tick= max(int(ceil(runAt / self.tickSeconds)), self.tick + 1)
+            self.buckets.setdefault(tick, []).append(item)
+         self.count+= len(timers)
+
+   def due(self, currentTime):
+      '''
+      Pops the items due by currentTime
+      '''
+
+      with self.lock:
+
+         tick= int(currentTime / self.tickSeconds)
+
+         # after a long stall only visit the ticks which have items
+         if tick - self.tick > len(self.buckets):
+            ticks= sorted([bucket for bucket in self.buckets if bucket <= tick])
+         else:
+            ticks= xrange(self.tick + 1, tick + 1)
+
+         items= []
+         for bucket in ticks:
+            items.extend(self.buckets.pop(bucket, ()))
+
+         self.tick= max(self.tick, tick)
+         self.count-= len(items)
+
+      return items
+
+   def items(self):
+      '''
+      Returns a copy of the items waiting on the wheel in the order due
+      '''
+
+      with self.lock:
+         return [item for tick in sorted(self.buckets) for item in self.buckets[tick]]
 
 
 class SharedQueue(SyncManager):
@@ -57,29 +716,820 @@ class SharedQueue(SyncManager):
       '''
 
       self.opts= opts
-      self.qPipeline= JoinableQueue()
+      self.qPipeline= Pipeline(self.opts.rateLimit, self.opts.rateBurst)
+
+      # pipeline items of tasks forked to run later
+      self.timers= TimerWheel(self.opts.timerTick)
+      self.timerThread= Thread(target= self.releaseTimers)
+      self.timerThread.setDaemon(True)
 
       print 'using %s datastore' % (self.opts.storeType)
       if self.opts.storeType == 'memcache': 
-         self.qStore= MemcacheStore(self.opts.mcHost, self.opts.mcPort)
+         self.qStore= MemcacheStore(self.opts.mcHost, self.opts.mcPort, self.opts.storeCompressLen)
+      elif self.opts.storeType == 'sqlite':
+         self.qStore= SqliteStore(self.opts.storeFile, self.opts.storeCacheSize)
       else:
          self.qStore= dict()
            
 
       self.lock= Lock()
+
+      # backpressure on producers once the pipeline or the approximate
+      # bytes of the store reach their high-water marks
+      self.bounded= self.opts.highWater > 0 or self.opts.highWaterBytes > 0
+      self.pressured= False
+      self.drained= Condition()
+      self.storeBytes= 0
+      self.sizes= dict()
+
+      # processId -> (leaseExpires, workerId) of every claimed task
+      self.leases= dict()
+      self.leaseReaper= Thread(target= self.reapLeases)
+      self.leaseReaper.setDaemon(True)
+
+      # taskId -> (deque of (sequence, processId, status) of completions not
+      # yet acknowledged by the client, set of processIds completed and still
+      # in the store).  sequences are numbered across all tasks so a log
+      # dropped once its tasks are popped can be recreated under the cursor
+      # the client already holds
+      self.completions= dict()
+      self.completionSequence= count(1)
+      self.completed= Condition()
+
+      # tag -> taskId -> status -> set of processIds of tagged tasks
+      self.tagIndex= dict()
+
+      # codeHash -> (taskName, marshalled func_code) of forked task code
+      self.codes= dict()
+
+      # replay the journal into the pipeline and store before serving.  the
+      # threads which can't wait on the journal leave the sequence number
+      # of what they journaled to be waited on
+      self.journal= None
+      self.deferred= local()
+      if self.opts.journalDir != None:
+         journal= Journal(self.opts.journalDir, self.opts.journalSync)
+         self.recover(journal)
+         journal.start()
+         self.journal= journal
+
+         self.snapshotter= Thread(target= self.snapshotJournal)
+         self.snapshotter.setDaemon(True)
        
       # register handlers with the base manager
       self.register('getPipeline', callable= lambda: self.qPipeline)
       self.register('getStore', callable= lambda: self.qStore, proxytype= DictProxy)
-      self.register('setFileContents', callable= self.setFileContents)
-      self.register('getFileContents', callable= self.getFileContents)
-      self.register('deleteFile', callable= self.deleteFile)
+      self.register('setFileContents', callable= self.writeFile)
+      self.register('getFileContents', callable= self.readFile)
+      self.register('deleteFile', callable= self.removeFile)
+      self.register('getSharedQueue', callable= lambda: self, exposed= EXPOSED)
 
       # create the manager instance and bind it to a ipaddr:port
       (qHost, qPort, qKey)= self.opts.queue.split(':')
-      super(SharedQueue, self).__init__(address= (qHost, int(qPort)), authkey= qKey)
+      super(SharedQueue, self).__init__(address= (qHost, int(qPort)), authkey= qKey, serializer= SERIALIZER)
 
-   def setFileContents(self, processId, results):
+   def putMany(self, items, block= True, timeout= None):
+      '''
+      Writes a batch of (processId, storeData) items to the store and
+      queues their processIds on the pipeline within a single call.  while
+      the queue is over a high-water mark it waits for it to drain to the
+      low-water mark, raising Full if it doesn't by timeout or block is False
+      '''
+
+      if not self.admit(block, timeout):
+         raise Full('queue is over its high-water mark %s' % (self.depth()))
+
+      return self.enqueue(items)
+
+   def enqueue(self, items):
+      '''
+      Writes a batch of (processId, storeData) items to the store and
+      queues their processIds on the pipeline
+      '''
+
+      currentTime= time()
+      for (processId, storeData) in items:
+         if 'delay' in storeData:
+            storeData['runAt']= currentTime + storeData.pop('delay')
+
+      self.qStore.update(items)
+      self.updateTagIndex(items)
+      self.schedule(items, currentTime)
+      self.trackBytes(items)
+      self.journalOp('put', items)
+
+      return len(items)
+
+   def schedule(self, items, currentTime):
+      '''
+      Queues the (processId, storeData) items on the pipeline, or on the
+      timer wheel for those which shouldn't run until later
+      '''
+
+      pipeline= []
+      timers= []
+      for (processId, storeData) in items:
+         runAt= storeData.get('runAt')
+         if runAt != None and runAt > currentTime:
+            timers.append((runAt, self.pipelineItem(processId, storeData)))
+         else:
+            pipeline.append(self.pipelineItem(processId, storeData))
+
+      if timers:
+         self.timers.addMany(timers)
+
+      self.qPipeline.putMany(pipeline)
+
+   def releaseTimers(self):
+      '''
+      Moves tasks from the timer wheel onto the pipeline as they come due
+      and wakes the consumers of rate limited tasks whose token is due, and
+      the blocked claims whose timeout has passed
+      '''
+
+      while True:
+
+         sleep(self.opts.timerTick)
+
+         items= self.timers.due(time())
+         if items:
+            self.qPipeline.putMany(items)
+
+         # so do rate limited tasks as their tokens come back, and blocked
+         # claims time out
+         self.qPipeline.release()
+
+   def admit(self, block, timeout):
+      '''
+      Returns whether the queue is below its high-water marks, waiting up
+      to timeout for it to drain if it is not and block is set
+      '''
+
+      if not self.bounded:
+         return True
+
+      if timeout != None:
+         endTime= time() + timeout
+
+      with self.drained:
+
+         self.checkPressure()
+         while self.pressured and block:
+
+            if timeout == None:
+               self.drained.wait()
+            else:
+               remaining= endTime - time()
+               if remaining <= 0:
+                  break
+               self.drained.wait(remaining)
+
+            self.checkPressure()
+
+         return not self.pressured
+
+   def checkPressure(self):
+      '''
+      Raises the backpressure once the pipeline or store reaches its
+      high-water mark and releases it once both are down to their low-water
+      marks, waking the producers waiting on it
+      '''
+
+      if not self.bounded:
+         return
+
+      depth= self.qPipeline.qsize() + self.qPipeline.throttled()
+      with self.drained:
+
+         if self.pressured:
+            if (not self.opts.highWater or depth <= self.opts.highWater * self.opts.lowWater) and (not self.opts.highWaterBytes or self.storeBytes <= self.opts.highWaterBytes * self.opts.lowWater):
+               self.pressured= False
+               self.drained.notify_all()
+
+         elif (self.opts.highWater and depth >= self.opts.highWater) or (self.opts.highWaterBytes and self.storeBytes >= self.opts.highWaterBytes):
+            self.pressured= True
+
+   def trackBytes(self, items):
+      '''
+      Accounts for the approximate size of each (processId, storeData)
+      item, replacing whatever size it was accounted with before
+      '''
+
+      if not self.opts.highWaterBytes:
+         return
+
+      sizes= [(processId, len(dumps(storeData, HIGHEST_PROTOCOL))) for (processId, storeData) in items]
+      with self.drained:
+         for (processId, size) in sizes:
+            self.storeBytes+= size - self.sizes.get(processId, 0)
+            self.sizes[processId]= size
+
+      self.checkPressure()
+
+   def untrackBytes(self, processId):
+
+      if not self.opts.highWaterBytes:
+         return
+
+      with self.drained:
+         self.storeBytes-= self.sizes.pop(processId, 0)
+
+      self.checkPressure()
+
+   def depth(self):
+      '''
+      Returns the current depth of the queue against its high-water marks
+      so producers can pace themselves
+      '''
+
+      with self.drained:
+         self.checkPressure()
+         return dict(
+            pipeline= self.qPipeline.qsize(),
+            throttled= self.qPipeline.throttled(),
+            delayed= len(self.timers),
+            highWater= self.opts.highWater,
+            storeBytes= self.storeBytes,
+            highWaterBytes= self.opts.highWaterBytes,
+            pressured= self.pressured
+         )
+
+   def pipelineItem(self, processId, storeData):
+      '''
+      Returns the (processId, priority, tag, rateKey) pipeline item of a
+      store entry.  untagged tasks (tagged with their own processId) share
+      one sub-queue
+      '''
+
+      tag= storeData.get('tag')
+      return (processId, storeData.get('priority', 0), tag if tag != processId else None, storeData.get('rateKey'))
+
+   def registerCode(self, codeHash, taskName, code):
+      '''
+      Registers the marshalled code of a task function under its hash.
+      store entries refer to their code by codeHash
+      '''
+
+      if codeHash not in self.codes:
+         self.codes[codeHash]= (taskName, code)
+         self.journalOp('code', codeHash, taskName, code)
+
+   def getCode(self, codeHash):
+      '''
+      Returns the (taskName, marshalled code) registered under codeHash
+      '''
+
+      return self.codes.get(codeHash)
+
+   def setRateLimit(self, rateKey, rate, burst= None):
+      '''
+      Limits the tasks of rateKey handed out to rate a second, with bursts
+      of up to burst (by default --rateBurst).  0 for unlimited
+      '''
+
+      burst= self.opts.rateBurst if burst == None else burst
+      self.qPipeline.setRate(rateKey, rate, burst)
+      self.journalOp('rate', rateKey, rate, burst)
+
+   def claim(self, n, workerId, leaseSeconds, timeout= 0):
+      '''
+      Atomically pops up to n processIds off the pipeline, marks them as
+      running under a lease held by workerId and returns their store entries.
+      while the pipeline is empty it waits for up to timeout seconds
+      '''
+
+      processIds= self.qPipeline.getMany(n, timeout)
+
+      leaseExpires= time() + leaseSeconds
+
+      claimed= []
+      for (processId, storeData) in zip(processIds, self.getEntries(processIds)):
+
+         # task was killed, or completed by an expired lease holder, while
+         # it was waiting in the pipeline
+         if storeData == None or storeData.get('status') != 'waiting':
+            continue
+
+         storeData.update([
+            ('status', 'running'),
+            ('workerId', workerId),
+            ('leaseExpires', leaseExpires),
+            ('attempts', storeData.get('attempts', 0) + 1)
+         ])
+         claimed.append((processId, storeData))
+
+      self.qStore.update(claimed)
+      self.updateTagIndex(claimed)
+
+      with self.lock:
+         self.leases.update([(processId, (leaseExpires, workerId)) for (processId, storeData) in claimed])
+
+      self.checkPressure()
+
+      if claimed:
+         self.journalOp('claim', [(processId, workerId, leaseExpires, storeData.get('attempts')) for (processId, storeData) in claimed])
+
+      return [storeData for (processId, storeData) in claimed]
+
+   def heartbeat(self, processIds, workerId, leaseSeconds):
+      '''
+      Extends the leases workerId holds on the given processIds.  returns
+      the processIds whose lease is no longer held by workerId
+      '''
+
+      leaseExpires= time() + leaseSeconds
+
+      lost= []
+      with self.lock:
+         for processId in processIds:
+            if self.leases.get(processId, (None, None))[1] == workerId:
+               self.leases[processId]= (leaseExpires, workerId)
+            else:
+               lost.append(processId)
+
+      return lost
+
+   def complete(self, processId, updates):
+      '''
+      Records the outcome of a claimed task in the store and releases its
+      lease.  updates is a dict of store items (status, results, transport).
+      a task forked with retries which errors is requeued instead while it
+      has retries left
+      '''
+
+      with self.lock:
+         self.leases.pop(processId, None)
+
+      storeData= self.qStore.get(processId)
+
+      # task was killed while it was running
+      if storeData == None:
+         return
+
+      if updates.get('status') == 'error' and storeData.get('retries'):
+         updates= dict(updates, history= storeData.get('history', []) + [dict(
+            attempt= storeData.get('attempts'),
+            workerId= storeData.get('workerId'),
+            failedAt= time(),
+            results= updates.get('results')
+         )])
+
+         if storeData.get('retried', 0) < storeData.get('retries'):
+            self.retry(processId, storeData, updates.get('history'))
+            return
+
+      storeData.update(updates)
+      storeData.pop('leaseExpires', None)
+      self.qStore.update([(processId, storeData)])
+      self.updateTagIndex([(processId, storeData)])
+      self.trackBytes([(processId, storeData)])
+      self.journalOp('complete', processId, updates)
+
+      (taskId, subTaskId)= processId.split('.')
+      with self.completed:
+         (events, processIds)= self.completions.setdefault(taskId, (deque(), set()))
+         events.append((next(self.completionSequence), processId, storeData.get('status')))
+         processIds.add(processId)
+         self.completed.notify_all()
+
+   def retry(self, processId, storeData, history):
+      '''
+      Requeues an errored task to run again, under the same processId, after
+      its backoff doubled for each retry so far and jittered so the retries
+      of tasks which failed together spread out
+      '''
+
+      retried= storeData.get('retried', 0)
+      backoff= min(storeData.get('backoff', 1.0) * 2 ** retried, self.opts.maxBackoff)
+
+      print 'task %s failed attempt %s retrying in %0.1fs' % (processId, storeData.get('attempts'), backoff)
+
+      storeData.update([
+         ('status', 'waiting'),
+         ('retried', retried + 1),
+         ('history', history),
+         ('runAt', time() + uniform(backoff / 2.0, backoff))
+      ])
+      storeData.pop('leaseExpires', None)
+
+      self.enqueue([(processId, storeData)])
+
+   def waitAny(self, taskId, cursor= 0, timeout= None):
+      '''
+      Waits for tasks of taskId to complete.  cursor is the cursor returned
+      by the previous call, completions before it have been seen by the
+      caller and are discarded.  returns the list of (processId, status)
+      completed since cursor and the new cursor
+      '''
+
+      if timeout != None:
+         endTime= time() + timeout
+
+      with self.completed:
+
+         while True:
+
+            log= self.completions.get(taskId)
+            events= log[0] if log != None else deque()
+            while len(events) > 0 and events[0][0] < cursor:
+               events.popleft()
+
+            if len(events) > 0:
+               break
+
+            if timeout == None:
+               self.completed.wait()
+            else:
+               remaining= endTime - time()
+               if remaining <= 0:
+                  break
+               self.completed.wait(remaining)
+
+            # completions were cleared while waiting
+            if log != None and self.completions.get(taskId) is not log:
+               break
+
+         if len(events) > 0:
+            cursor= events[-1][0] + 1
+
+         return ([(processId, status) for (sequence, processId, status) in events], cursor)
+
+   def clearCompletions(self, taskId):
+      '''
+      Discards the completions recorded for taskId
+      '''
+
+      with self.completed:
+         self.completions.pop(taskId, None)
+         self.completed.notify_all()
+
+   def getStatuses(self, processIds):
+      '''
+      Returns the store status of each of the given processIds
+      '''
+
+      return [(storeData or dict()).get('status') for storeData in self.getEntries(processIds)]
+
+   def getMany(self, processIds):
+      '''
+      Returns the store entry of each of the given processIds
+      '''
+
+      return self.getEntries(processIds)
+
+   def getEntries(self, processIds):
+      '''
+      Returns the store entry of each of the processIds, in one round trip
+      to the store where it supports it
+      '''
+
+      if isinstance(self.qStore, dict):
+         return [self.qStore.get(processId) for processId in processIds]
+
+      return self.qStore.getMany(processIds)
+
+   def pop(self, processId):
+      '''
+      Pops the store entry of processId out of the store and the tag index
+      '''
+
+      try:
+         storeData= self.qStore.pop(processId)
+      except KeyError:
+         storeData= None
+
+      if storeData == None:
+         return None
+
+      self.removeTagIndex(processId, storeData)
+      self.untrackBytes(processId)
+      self.journalOp('pop', processId)
+
+      # the completions of a task are dropped once none of its entries are
+      # left in the store to be fetched
+      (taskId, subTaskId)= processId.split('.')
+      with self.completed:
+         log= self.completions.get(taskId)
+         if log != None:
+            log[1].discard(processId)
+            if len(log[1]) == 0:
+               self.completions.pop(taskId)
+
+      return storeData
+
+   def removeTagIndex(self, processId, storeData):
+      '''
+      Removes processId from the tag index
+      '''
+
+      (taskId, subTaskId)= processId.split('.')
+      tag= storeData.get('tag')
+      with self.lock:
+         taskIds= self.tagIndex.get(tag, dict())
+         statuses= taskIds.get(taskId, dict())
+         for (status, processIds) in statuses.items():
+            processIds.discard(processId)
+            if len(processIds) == 0:
+               statuses.pop(status)
+         if len(statuses) == 0:
+            taskIds.pop(taskId, None)
+         if len(taskIds) == 0:
+            self.tagIndex.pop(tag, None)
+
+   def updateTagIndex(self, items):
+      '''
+      Files each (processId, storeData) item under its tag and current
+      status.  untagged tasks (tagged with their own processId) are not indexed
+      '''
+
+      with self.lock:
+         for (processId, storeData) in items:
+
+            tag= storeData.get('tag')
+            if tag == processId:
+               continue
+
+            (taskId, subTaskId)= processId.split('.')
+            statuses= self.tagIndex.setdefault(tag, dict()).setdefault(taskId, dict())
+            for (status, processIds) in statuses.items():
+               processIds.discard(processId)
+               if len(processIds) == 0:
+                  statuses.pop(status)
+            statuses.setdefault(storeData.get('status'), set()).add(processId)
+
+   def getByTag(self, tag, status= None, limit= None, taskId= None):
+      '''
+      Returns the store entries of the tasks tagged with tag, optionally
+      only those with the given status, at most limit of them and only
+      those forked by taskId
+      '''
+
+      processIds= []
+      with self.lock:
+         taskIds= self.tagIndex.get(tag, dict())
+         for statuses in [taskIds.get(taskId, dict())] if taskId != None else taskIds.values():
+            for (indexStatus, indexProcessIds) in statuses.items():
+               if status == None or indexStatus == status:
+                  processIds.extend(islice(indexProcessIds, limit - len(processIds) if limit != None else None))
+
+      return filter(lambda storeData: storeData != None, self.getMany(processIds))
+
+   def countByTag(self, tag, taskId= None):
+      '''
+      Returns the number of tasks tagged with tag by status, optionally
+      only counting those forked by taskId
+      '''
+
+      counts= dict()
+      with self.lock:
+         taskIds= self.tagIndex.get(tag, dict())
+         for statuses in [taskIds.get(taskId, dict())] if taskId != None else taskIds.values():
+            for (status, processIds) in statuses.items():
+               counts[status]= counts.get(status, 0) + len(processIds)
+
+      return counts
+
+   def journalOp(self, *record):
+      '''
+      Journals an operation which has been applied to the pipeline and
+      store, returning once it is on disk.  unless the thread defers the
+      wait, then it returns right away
+      '''
+
+      if self.journal != None:
+         sequence= self.journal.append(record)
+         if getattr(self.deferred, 'defer', False):
+            self.deferred.sequence= sequence
+         else:
+            self.journal.wait(sequence)
+
+   def deferSync(self):
+      '''
+      Has the calling thread's operations journaled without waiting for
+      them to be on disk, for the async server to answer its calls once
+      they are
+      '''
+
+      self.deferred.defer= True
+
+   def journaled(self):
+      '''
+      Returns, and forgets, the sequence number of the last operation the
+      calling thread journaled since it last asked, None if none
+      '''
+
+      sequence= getattr(self.deferred, 'sequence', None)
+      self.deferred.sequence= None
+
+      return sequence
+
+   def recover(self, journal):
+      '''
+      Rebuilds the pipeline, store, leases, code registry and rate limits
+      from the latest journal snapshot and the operations journaled since
+      '''
+
+      startTime= time()
+
+      # processIds waiting on the pipeline in order
+      waiting= OrderedDict()
+      records= 0
+
+      for record in journal.recover():
+
+         records+= 1
+         op= record[0]
+
+         if op == 'store':
+            (op, items)= record
+            self.qStore.update(items)
+            self.updateTagIndex(items)
+            self.trackBytes(items)
+
+         elif op == 'pipeline':
+            (op, processIds)= record
+            waiting.update([(processId, None) for processId in processIds])
+
+         elif op == 'leases':
+            (op, leases)= record
+            self.leases.update(leases)
+
+         elif op == 'codes':
+            (op, codes)= record
+            self.codes.update(codes)
+
+         elif op == 'code':
+            (op, codeHash, taskName, code)= record
+            self.codes[codeHash]= (taskName, code)
+
+         elif op == 'rates':
+            (op, rates)= record
+            for (rateKey, (rate, burst)) in rates.items():
+               self.qPipeline.setRate(rateKey, rate, burst)
+
+         elif op == 'rate':
+            (op, rateKey, rate, burst)= record
+            self.qPipeline.setRate(rateKey, rate, burst)
+
+         elif op == 'put':
+            (op, items)= record
+            self.qStore.update(items)
+            self.updateTagIndex(items)
+            self.trackBytes(items)
+            for (processId, storeData) in items:
+               waiting.pop(processId, None)
+               waiting[processId]= None
+
+         elif op == 'claim':
+            (op, claims)= record
+            claimed= []
+            for (processId, workerId, leaseExpires, attempts) in claims:
+               waiting.pop(processId, None)
+               storeData= self.qStore.get(processId)
+               if storeData != None:
+                  storeData.update([
+                     ('status', 'running'),
+                     ('workerId', workerId),
+                     ('leaseExpires', leaseExpires),
+                     ('attempts', attempts)
+                  ])
+                  claimed.append((processId, storeData))
+                  self.leases[processId]= (leaseExpires, workerId)
+            self.qStore.update(claimed)
+            self.updateTagIndex(claimed)
+
+         elif op == 'complete':
+            (op, processId, updates)= record
+            self.leases.pop(processId, None)
+            storeData= self.qStore.get(processId)
+            if storeData != None:
+               storeData.update(updates)
+               storeData.pop('leaseExpires', None)
+               self.qStore.update([(processId, storeData)])
+               self.updateTagIndex([(processId, storeData)])
+               self.trackBytes([(processId, storeData)])
+
+         elif op == 'pop':
+            (op, processId)= record
+            waiting.pop(processId, None)
+            self.leases.pop(processId, None)
+            try:
+               storeData= self.qStore.pop(processId)
+            except KeyError:
+               storeData= None
+            if storeData != None:
+               self.removeTagIndex(processId, storeData)
+               self.untrackBytes(processId)
+
+      # the snapshot may hold ids that were claimed or killed before it was taken
+      processIds= list(waiting)
+      self.schedule([(processId, storeData) for (processId, storeData) in zip(processIds, self.getEntries(processIds)) if storeData != None and storeData.get('status') == 'waiting'], time())
+
+      print 'recovered %s journal records, %s store entries, %s waiting, %s delayed, %s leased in %0.3fs' % (records, len(self.qStore), self.qPipeline.qsize(), len(self.timers), len(self.leases), time() - startTime)
+
+   def snapshot(self):
+      '''
+      Snapshots the pipeline, store, leases, code registry and rate limits
+      and compacts the journal up to the snapshot
+      '''
+
+      startTime= time()
+
+      # anything applied from here on is journaled in the new generation
+      generation= self.journal.rotate()
+
+      def records():
+
+         yield ('codes', dict(self.codes))
+
+         with self.qPipeline.mutex:
+            rates= dict(self.qPipeline.rates)
+         yield ('rates', rates)
+
+         with self.lock:
+            leases= dict(self.leases)
+         yield ('leases', leases)
+
+         yield ('pipeline', self.qPipeline.items() + [item[0] for item in self.timers.items()])
+
+         if isinstance(self.qStore, dict):
+            items= self.qStore.items()
+            chunks= (items[i:i + 1000] for i in xrange(0, len(items), 1000))
+         else:
+            chunks= self.qStore.chunks(1000)
+
+         for chunk in chunks:
+            yield ('store', [(processId, dict(storeData)) for (processId, storeData) in chunk])
+
+      self.journal.snapshot(generation, records())
+
+      print 'journal snapshot %s taken in %0.3fs' % (generation, time() - startTime)
+
+   def snapshotJournal(self):
+      '''
+      Periodically snapshots the queue so the journal stays short
+      '''
+
+      written= self.journal.written
+      while True:
+
+         sleep(self.opts.snapshotInterval)
+
+         # nothing journaled since the last snapshot
+         if self.journal.written == written:
+            continue
+
+         try:
+            self.snapshot()
+            written= self.journal.written
+         except Exception, e:
+            print >> stderr, 'journal snapshot failed: %s' % (str(e))
+
+   def reapLeases(self):
+      '''
+      Requeues running tasks whose lease has expired (eg, the node went
+      away).  tasks which have used up their attempts are marked as errors
+      '''
+
+      while True:
+
+         sleep(self.opts.reapInterval)
+
+         currentTime= time()
+         with self.lock:
+            expired= [processId for (processId, (leaseExpires, workerId)) in self.leases.items() if leaseExpires <= currentTime]
+            [self.leases.pop(processId) for processId in expired]
+
+         requeue= []
+         for processId in expired:
+
+            storeData= self.qStore.get(processId)
+            if storeData == None or storeData.get('status') != 'running':
+               continue
+
+            # attempts spent on retries of errors don't count against the lease
+            attempts= storeData.get('attempts', 1) - storeData.get('retried', 0)
+            if attempts >= self.opts.maxAttempts:
+               print >> stderr, 'lease expired on %s after %s attempts' % (processId, attempts)
+               self.complete(processId, dict(
+                  status= 'error',
+                  results= {
+                     'error': 'lease expired after %s attempts' % (attempts),
+                     'taskName': storeData.get('taskName'),
+                     'workerId': storeData.get('workerId')
+                  },
+                  transport= 'store'
+               ))
+            else:
+               print 'lease expired on %s requeueing attempt %s' % (processId, attempts + 1)
+               storeData.update([('status', 'waiting')])
+               storeData.pop('leaseExpires', None)
+               requeue.append((processId, storeData))
+
+         if requeue:
+            self.enqueue(requeue)
+
+   def writeFile(self, processId, results):
   
       (taskId, subTaskId)= processId.split('.')
       taskDir= path.join(self.opts.taskDir, taskId)
@@ -93,7 +1543,7 @@ class SharedQueue(SyncManager):
       fh.write(results)
       fh.close()
 
-   def getFileContents(self, processId):
+   def readFile(self, processId):
 
       (taskId, subTaskId)= processId.split('.')
       taskDir= path.join(self.opts.taskDir, taskId)
@@ -103,7 +1553,7 @@ class SharedQueue(SyncManager):
       fh.close()
       return Array('c', results)
 
-   def deleteFile(self, processId):
+   def removeFile(self, processId):
 
       (taskId, subTaskId)= processId.split('.')
       taskDir= path.join(self.opts.taskDir, taskId)
@@ -127,8 +1577,21 @@ class SharedQueue(SyncManager):
 
       print "shared queue running", datetime.now()
 
-      # get the server process from the base manager and start handling requests
-      server= self.get_server()
+      # start the reaper of expired task leases and the release of delayed tasks
+      self.leaseReaper.start()
+      self.timerThread.start()
+
+      if self.journal != None:
+         self.snapshotter.start()
+
+      # get the server process from the base manager, or the single threaded
+      # async server, and start handling requests
+      if self.opts.server == 'async':
+         (qHost, qPort, qKey)= self.opts.queue.split(':')
+         server= AsyncServer(self, (qHost, int(qPort)), qKey, EXPOSED)
+      else:
+         server= self.get_server()
+
       server.serve_forever()
 
 
@@ -166,10 +1629,25 @@ def parseArgs(argv):
    [ optParser.add_option(opt) for opt in [
       make_option('-f', '--foreground', action='store_true', dest= 'foreground', default= False, help= 'run in foreground'),
       make_option('-q', '--queue', default= '0.0.0.0:50001:impetus', help= 'ip:port:key to bind the queue to'),
-      make_option('-s', '--storeType', default= 'dict', help= 'dict|memcache:host:port'),
+      make_option('-S', '--server', default= 'manager', help= 'manager|async, clients of an async server append :async to the queue ip:port:key'),
+      make_option('-s', '--storeType', default= 'dict', help= 'dict|memcache:host:port|sqlite:filename'),
+      make_option('-c', '--storeCacheSize', default= 100000, type= int, help= 'number of entries the sqlite store caches in memory'),
+      make_option('-z', '--storeCompressLen', default= 2048, type= int, help= 'entries larger than this many bytes are compressed in the memcache store'),
       make_option('-p', '--pidDir', default= path.join(getcwd(), '../pid'), help= 'path to pid directory'),
       make_option('-o', '--logDir', default= path.join(getcwd(), '../log'), help= 'path to log directory'),
-      make_option('-d', '--taskDir', default= path.join(getcwd(), '../tasks'), help= 'path to task directory')
+      make_option('-d', '--taskDir', default= path.join(getcwd(), '../tasks'), help= 'path to task directory'),
+      make_option('-r', '--reapInterval', default= 5, type= float, help= 'seconds between checks for expired task leases'),
+      make_option('-a', '--maxAttempts', default= 3, type= int, help= 'attempts a task gets before an expired lease marks it as an error'),
+      make_option('-m', '--maxBackoff', default= 600, type= float, help= 'most seconds a task forked with retries waits before it is retried'),
+      make_option('-t', '--timerTick', default= 0.1, type= float, help= 'seconds between releases of delayed tasks onto the pipeline, and the resolution of claim timeouts'),
+      make_option('-l', '--rateLimit', default= 0, type= float, help= 'tasks a second handed out per rateKey unless set by setRateLimit, 0 for unlimited'),
+      make_option('-b', '--rateBurst', default= 1, type= float, help= 'tasks of a rateKey handed out back to back after it has been idle'),
+      make_option('-w', '--highWater', default= 0, type= int, help= 'pipeline length at which forking tasks blocks, 0 for unbounded'),
+      make_option('-W', '--highWaterBytes', default= 0, type= int, help= 'approximate store bytes at which forking tasks blocks, 0 for unbounded'),
+      make_option('-L', '--lowWater', default= 0.8, type= float, help= 'fraction of the high-water marks forking tasks resumes at'),
+      make_option('-j', '--journalDir', default= None, help= 'path to journal directory, enables recovery of the queue after a restart'),
+      make_option('-y', '--journalSync', default= 0.002, type= float, help= 'seconds to gather journal writes into one fsync'),
+      make_option('-n', '--snapshotInterval', default= 300, type= float, help= 'seconds between journal snapshots')
    ]]
 
    optParser.set_usage('%%prog %s' % ('|'.join(opt_args)))
@@ -189,6 +1667,17 @@ def parseArgs(argv):
          print 'invalid memcache parameters memcache:<host>:<port> in --storeType'
          optParser.print_help()
          exit(2)
+
+   if 'sqlite' in opts.storeType:
+      try:
+         (storeType, storeFile)= opts.storeType.split(':', 1)
+         setattr(opts, 'storeType', storeType)
+         setattr(opts, 'storeFile', storeFile)
+      except:
+         print 'invalid sqlite parameters sqlite:<filename> in --storeType'
+         optParser.print_help()
+         exit(2)
+
    
 
    setattr(opts, 'PIDFile', path.join(opts.pidDir, argv[0].replace('.py', '.pid')))
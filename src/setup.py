@@ -12,7 +12,7 @@ setup(
       This package is a python high level interface for submitting tasks to the Impetus
       Autoscaling Asynchronous Distributed Processing Framework
    ''',
-   py_modules= ['bot', 'task', 'transports', 'configparser']
+   py_modules= ['bot', 'task', 'transports', 'configparser', 'connection', 'shard', 'asyncqueue']
 
 )
 
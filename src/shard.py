@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+'''
+   Date: 10/18/2026
+   Name: shard
+   Desc: Routes taskIds to the shards of a sharded queue by consistent
+   hashing.  each shard is an ordinary queue instance, the queue is given
+   to clients as a comma separated list of <host>:<port>:<security key>,
+   with :async appended for shards running the async server
+'''
+
+from bisect import bisect
+from hashlib import md5
+from multiprocessing.managers import SyncManager
+
+from connection import SERIALIZER
+from asyncqueue import AsyncManager
+
+class HashRing(object):
+   '''
+   Consistent hash ring -- each node owns the keys hashing between its
+   points and the points before them, so adding or removing a node only
+   moves the keys of its neighbours
+   '''
+
+   def __init__(self, nodes, replicas= 100):
+
+      self.points= []
+      self.nodes= []
+
+      for (point, node) in sorted([(self.__point__(node, replica), node) for node in nodes for replica in range(replicas)]):
+         self.points.append(point)
+         self.nodes.append(node)
+
+   def __point__(self, key, replica= 0):
+      return int(md5('%s#%s' % (key, replica)).hexdigest()[:8], 16)
+
+   def get(self, key):
+      '''
+      Returns the node owning key
+      '''
+
+      i= bisect(self.points, self.__point__(key))
+
+      return self.nodes[i % len(self.nodes)]
+
+
+class Aggregate(object):
+   '''
+   Sums qsize(), qsizes() and len() over a proxy from every shard, and
+   waits on them in turn for waitSize()
+   '''
+
+   def __init__(self, proxies):
+
+      self.proxies= proxies
+
+   def qsize(self):
+      return sum([proxy.qsize() for proxy in self.proxies])
+
+   def qsizes(self):
+
+      qsizes= dict()
+      for proxy in self.proxies:
+         for (priority, qsize) in proxy.qsizes().items():
+            qsizes[priority]= qsizes.get(priority, 0) + qsize
+
+      return qsizes
+
+   def __len__(self):
+      return sum([len(proxy) for proxy in self.proxies])
+
+   def waitSize(self, size, timeout):
+
+      qsizes= [proxy.qsize() for proxy in self.proxies]
+      for (i, proxy) in enumerate(self.proxies):
+         if sum(qsizes) > size:
+            break
+         qsizes[i]= proxy.waitSize(size - sum(qsizes) + qsizes[i], float(timeout) / len(self.proxies))
+
+      return sum(qsizes)
+
+
+class Shards(object):
+   '''
+   Connections to the shards of the queue, made the first time a shard is
+   used.  handlers must be registered with SyncManager before connecting
+   '''
+
+   def __init__(self, queue):
+
+      self.addresses= queue.split(',')
+      self.ring= HashRing(self.addresses)
+      self.managers= dict()
+
+   def __len__(self):
+      return len(self.addresses)
+
+   def connect(self, address):
+      '''
+      Returns the manager connected to the shard at address
+      '''
+
+      manager= self.managers.get(address)
+      if manager == None:
+         (qHost, qPort, qKey)= address.split(':')[:3]
+         if address.endswith(':async'):
+            manager= AsyncManager(address= (qHost, int(qPort)), authkey= qKey)
+         else:
+            manager= SyncManager(address= (qHost, int(qPort)), authkey= qKey, serializer= SERIALIZER)
+         manager.connect()
+         self.managers[address]= manager
+
+      return manager
+
+   def reconnect(self):
+      '''
+      Drops every connection, they are made again on next use
+      '''
+
+      self.managers.clear()
+
+   def route(self, taskId):
+      '''
+      Returns the address of the shard owning taskId
+      '''
+
+      if len(self.addresses) == 1:
+         return self.addresses[0]
+
+      return self.ring.get(taskId)
+
+   def manager(self, taskId):
+      '''
+      Returns the manager connected to the shard owning taskId
+      '''
+
+      return self.connect(self.route(taskId))
+
+   def pipeline(self):
+      '''
+      Returns the pipelines of every shard as one
+      '''
+
+      return Aggregate([self.connect(address).getPipeline() for address in self.addresses])
+
+   def store(self):
+      '''
+      Returns the stores of every shard as one
+      '''
+
+      return Aggregate([self.connect(address).getStore() for address in self.addresses])
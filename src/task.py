@@ -18,10 +18,13 @@ from sys import argv
 from uuid import uuid1
 from urllib2 import urlopen
 from marshal import dumps
+from hashlib import sha1
 from copy import deepcopy
 from threading import Lock
+from collections import deque
 
 from transports import S3File, FileStore
+from shard import Shards
 
 class Task(object):
 
@@ -30,7 +33,10 @@ class Task(object):
 
    def __init__(self, queue, taskId= str(uuid1()), s3= None, taskDir= None):
       """creates an instance of Task
-      :param queue: <host>:<port>:<security key> of queue instance
+      :param queue: <host>:<port>:<security key> of queue instance, or a
+      comma separated list of them when the queue is sharded. the task
+      uses the shard its taskId hashes to. append :async for queues
+      running the async server.
       :param taskId: optional, auto generated guid representing this 
       instance of Task. all jobs forked with  thecurrent instance will 
       assume this taskId. optionally, the developer may pass in a taskId that is
@@ -45,22 +51,29 @@ class Task(object):
       self.s3= s3
       self.subTaskId= 0
       self.subTasks= dict()
+      self.tags= dict()
+      self.statuses= dict()
+      self.cursor= 0
+      self.outstanding= dict()
+      self.completed= dict()
+      self.codeHashes= dict()
       self.sleep= 0.1
       self.taskDir= taskDir 
       self.lock= Lock()
 
-      (qHost, qPort, qKey)= queue.split(':')
       SyncManager.register('getPipeline')
       SyncManager.register('getStore')
       SyncManager.register('getFileContents')
       SyncManager.register('setFileContents')
       SyncManager.register('deleteFile')
+      SyncManager.register('getSharedQueue')
 
-      self.queue= SyncManager(address= (qHost, int(qPort)), authkey= qKey)
-      self.queue.connect()
+      self.shards= Shards(queue)
+      self.queue= self.shards.manager(self.taskId)
 
       self.pipeline= self.queue.getPipeline()
       self.store= self.queue.getStore()
+      self.sharedQueue= self.queue.getSharedQueue()
 
       super(Task, self).__init__()
 
@@ -146,13 +159,99 @@ class Task(object):
             
       return results
 
-   def forkTask(self, taskCode, taskArgs, tag= None, transport= 'store'):
+   def __registerCode__(self, taskCode):
+      """used internally by Task to register the code of the function/method
+      being forked with the queue's code registry.  the code is marshalled
+      and sent to the queue once, tasks refer to it by its hash.
+      :param taskCode: the function/method being forked
+      :returns: the hash of the marshalled func_code of taskCode
+      """
+
+      with self.lock:
+         codeHash= self.codeHashes.get(taskCode.func_code)
+
+      if codeHash == None:
+         code= dumps(taskCode.func_code)
+         codeHash= sha1(code).hexdigest()
+         self.sharedQueue.registerCode(codeHash, taskCode.func_name, code)
+         with self.lock:
+            self.codeHashes[taskCode.func_code]= codeHash
+
+      return codeHash
+
+   def __storeData__(self, processId, taskCode, codeHash, taskArgs, tag, transport, priority, runAt, delay, rateKey, retries, backoff, taskTimeout):
+      """used internally by Task to build the data store entry for a task.
+      :param processId: the processId of the task
+      :param taskCode: the function/method being forked
+      :param codeHash: the hash of taskCode in the queue's code registry
+      :param taskArgs: the arguments to be passed to taskCode
+      :param tag: optional tag of the task
+      :param transport: data transport of the results
+      :param priority: the priority of the task on the queue
+      :param runAt: optional time the task should run no earlier than
+      :param delay: optional seconds from now the task should run no earlier than
+      :param rateKey: optional key the task is rate limited by
+      :param retries: times the task is retried when it raises
+      :param backoff: seconds before the first retry of the task
+      :param taskTimeout: optional seconds the task may run for
+      :returns: the data store entry for the task
+      """
+
+      storeData= dict(
+         processId= processId,
+         taskName= taskCode.func_name,
+         codeHash= codeHash,
+         taskArgs= taskArgs,
+         tag= tag if tag != None else processId,
+         status= 'waiting',
+         results= None,
+         transport= transport,
+         priority= priority
+      )
+
+      if runAt != None:
+         storeData['runAt']= runAt
+      if delay != None:
+         storeData['delay']= delay
+      if rateKey != None:
+         storeData['rateKey']= rateKey
+      if retries > 0:
+         storeData['retries']= retries
+         storeData['backoff']= backoff
+      if taskTimeout != None:
+         storeData['taskTimeout']= taskTimeout
+
+      return storeData
+
+   def __trackSubTasks__(self, subTaskIds, tag):
+      """used internally by Task to start tracking newly forked subTasks.
+      :param subTaskIds: the subTaskIds which were forked
+      :param tag: the tag the subTasks were forked with
+      """
+
+      forkTime= time()
+      with self.lock:
+         for subTaskId in subTaskIds:
+            self.subTasks[subTaskId]= forkTime
+            self.tags[subTaskId]= tag
+
+            # a fast subTask may have completed before we got to track it
+            if self.statuses.get(subTaskId) in ('ready', 'error'):
+               self.completed.setdefault(tag, deque()).append(subTaskId)
+            else:
+               self.outstanding[tag]= self.outstanding.get(tag, 0) + 1
+
+   def forkTask(self, taskCode, taskArgs, tag= None, transport= 'store', priority= 0, block= True, timeout= None, runAt= None, delay= None, rateKey= None, retries= 0, backoff= 1.0, taskTimeout= None):
       """submits a task to the system for processing
       :param taskCode: pointer to the method or function to fork.  the method
       must be defined as static. this method/function becomes the process
       entry point swpaned by node.  therefore, any packages used
       must be supported by node OR installed via the bootstrap, and
       imported by the function/method itself.
+      connections and handles worth reusing across tasks can be kept with
+      the global resources, eg resources.get('db', lambda: connect(dsn)),
+      which the node creates on first use, keeps per worker and closes
+      when the worker exits.
       :param taskArgs: a tupple of arguments to be passed to the function/method
       upon execution.
       :param tag: tag used to identifiy similary task operations. you may
@@ -161,6 +260,35 @@ class Task(object):
       :param transport: defines the data transport of the results.  defaults
       to 'store' which is an in memory data store.  other options include 's3'
       and 'file'
+      :param priority: integer priority of the task on the queue. the queue
+      hands out tasks weighted by 2 ** priority, so priority 1 tasks are
+      dequeued twice as often as priority 0 tasks waiting beside them. tasks
+      with the same priority and tag are dequeued in the order forked.
+      :param block: when the queue is over its high-water mark, wait for it
+      to drain. otherwise Queue.Full is raised right away.
+      :param timeout: optional seconds to wait for the queue to drain before
+      raising Queue.Full
+      :param runAt: optional time, in seconds since the epoch, the task
+      should run no earlier than. the task waits on the queue without
+      tying up a worker until then.
+      :param delay: optional seconds from now, by the queue's clock, the
+      task should run no earlier than
+      :param rateKey: optional key (eg, the hostname the task fetches from)
+      the task is rate limited by. the queue hands out the tasks of a
+      rateKey no faster than its rate limit, see .setRateLimit(), and hands
+      out other tasks meanwhile.
+      :param retries: times the queue retries the task when it raises,
+      under the same subTaskId, before its status becomes 'error'. each
+      failed attempt is kept in the task's 'history'.
+      :param backoff: seconds before the first retry, doubled for each
+      retry after (up to the queue's --maxBackoff) and jittered.
+      :param taskTimeout: optional seconds the task may run for. a task
+      running over it is interrupted (in workers running one task at a
+      time), or killed along with its worker once it runs over by the
+      node's --timeoutGrace. either way its status becomes 'error' with
+      'reason': 'timeout' in its results, and it is retried if forked
+      with retries. not to be confused with timeout, which is how long
+      forking waits on a full queue.
       :returns: a unique subTaskId for the forked task within the current 
       instance of Task
       """
@@ -170,25 +298,57 @@ class Task(object):
          self.subTaskId+= 1
 
       processId= self.__genProcessId__(subTaskId)
-
-      storeData= dict(
-         processId= processId,
-         taskName= taskCode.func_name,
-         taskCode= dumps(taskCode.func_code),
-         taskArgs= taskArgs,
-         tag= tag if tag != None else processId,
-         status= 'waiting',
-         results= None,
-         transport= transport
-      )
+      storeData= self.__storeData__(processId, taskCode, self.__registerCode__(taskCode), taskArgs, tag, transport, int(priority), runAt, delay, rateKey, int(retries), float(backoff), taskTimeout)
          
-      self.store.update([(processId, storeData)])
-      self.pipeline.put(processId)
+      self.sharedQueue.putMany([(processId, storeData)], block, timeout)
+      self.__trackSubTasks__([subTaskId], tag)
 
+      return subTaskId
+
+   def forkTasks(self, taskCode, taskArgsList, tag= None, transport= 'store', batchSize= 1000, priority= 0, block= True, timeout= None, runAt= None, delay= None, rateKey= None, retries= 0, backoff= 1.0, taskTimeout= None):
+      """submits many tasks running the same function/method to the system
+      for processing.  the function/method is marshalled once and the tasks
+      are sent to the queue in batches, one round-trip per batch.
+      :param taskCode: pointer to the method or function to fork. see
+      .forkTask() for details.
+      :param taskArgsList: an iterable of taskArgs, one per task to fork.
+      :param tag: optional tag applied to every forked task. see .forkTask()
+      :param transport: defines the data transport of the results. see
+      .forkTask()
+      :param batchSize: number of tasks to send to the queue per round-trip
+      :param priority: priority applied to every forked task. see .forkTask()
+      :param block: see .forkTask(). batches sent before Queue.Full is
+      raised stay forked.
+      :param timeout: see .forkTask(), applies to each batch
+      :param runAt: see .forkTask()
+      :param delay: see .forkTask()
+      :param rateKey: see .forkTask()
+      :param retries: see .forkTask()
+      :param backoff: see .forkTask()
+      :param taskTimeout: see .forkTask()
+      :returns: the range of subTaskIds forked by this call
+      """
+
+      taskArgsList= list(taskArgsList)
+      codeHash= self.__registerCode__(taskCode)
+
+      # reserve a contiguous block of subTaskIds for the whole submission
       with self.lock:
-         self.subTasks.update([(subTaskId, time())])
+         firstSubTaskId= self.subTaskId
+         self.subTaskId+= len(taskArgsList)
 
-      return subTaskId
+      for offset in range(0, len(taskArgsList), batchSize):
+
+         subTaskIds= range(firstSubTaskId + offset, firstSubTaskId + min(offset + batchSize, len(taskArgsList)))
+         items= []
+         for (subTaskId, taskArgs) in zip(subTaskIds, taskArgsList[offset:offset + batchSize]):
+            processId= self.__genProcessId__(subTaskId)
+            items.append((processId, self.__storeData__(processId, taskCode, codeHash, taskArgs, tag, transport, int(priority), runAt, delay, rateKey, int(retries), float(backoff), taskTimeout)))
+
+         self.sharedQueue.putMany(items, block, timeout)
+         self.__trackSubTasks__(subTaskIds, tag)
+
+      return xrange(firstSubTaskId, firstSubTaskId + len(taskArgsList))
 
    def getSubTask(self, subTaskId, storeItem= None):
       """returns the results from the store for the given subTaskId
@@ -207,6 +367,36 @@ class Task(object):
 
       return subtask.get(storeItem) if storeItem else subtask
 
+   def __resolveSubTasks__(self, subTasks, storeItem= None):
+      """used internally by Task to resolve the transports of results from
+      the data store.
+      :param subTasks: list of results from the data store
+      :param storeItem: optional particular item to get from the store
+      :returns: list of results with their transports resolved
+      """
+
+      resolved= []
+      for subtask in subTasks:
+         subtask= subtask if subtask != None else dict()
+         if subtask.get('status') == 'ready':
+            results= self.handleTransport(subtask.get('transport'), subtask.get('results'))
+            subtask.update([('results', results)])
+         resolved.append(subtask.get(storeItem) if storeItem else subtask)
+
+      return resolved
+
+   def __getSubTasks__(self, subTaskIds, storeItem= None):
+      """used internally by Task to get the results of many subTasks from
+      the data store in one call.
+      :param subTaskIds: the subTaskIds to get the store results for
+      :param storeItem: optional particular item to get from the store
+      :returns: list of results from the data store for the given subTaskIds
+      """
+
+      processIds= [self.__genProcessId__(subTaskId) for subTaskId in subTaskIds]
+
+      return self.__resolveSubTasks__(self.sharedQueue.getMany(processIds), storeItem)
+
    def getTask(self, storeItem= None, tag= None):
       """gets all the results for all the subTasks forked by the current
       instance of NoddleTask.
@@ -216,14 +406,158 @@ class Task(object):
       tag) for the current instance of Task
       """     
 
+      if tag != None:
+         return self.getByTag(tag, storeItem= storeItem)
+
       with self.lock:
-         subTasks= deepcopy(self.subTasks)
+         subTasks= self.subTasks.keys()
 
-      subTasks= [self.getSubTask(subTaskId, storeItem) for subTaskId in subTasks]
-      if tag != None:
-         subTasks= filter(lambda subTask: subTask.get('tag') == tag, subTasks) 
+      return self.__getSubTasks__(subTasks, storeItem)
 
-      return subTasks
+   def getByTag(self, tag, status= None, limit= None, storeItem= None):
+      """gets the results of the subTasks forked with the given tag by the
+      current instance of Task. the filtering is done by the queue so only
+      the matching results are transfered.
+      :param tag: tag the subTasks were forked with
+      :param status: optional status to filter by (eg, 'ready', 'error')
+      :param limit: optional maximum number of results to get
+      :param storeItem: optional specific item from the data store.
+      :returns: list of results for the matching subTasks
+      """
+
+      subTasks= self.sharedQueue.getByTag(tag, status, limit, self.getTaskId())
+
+      return self.__resolveSubTasks__(subTasks, storeItem)
+
+   def countByTag(self, tag):
+      """counts the subTasks forked with the given tag by the current instance
+      of Task by their status.
+      :param tag: tag the subTasks were forked with
+      :returns: dict of status to number of subTasks (eg, {'ready': 10})
+      """
+
+      return self.sharedQueue.countByTag(tag, self.getTaskId())
+
+   def setRateLimit(self, rateKey, rate, burst= None):
+      """limits how fast the queue hands out the tasks forked with the
+      given rateKey. keys without a limit of their own get the queue's
+      --rateLimit.
+      :param rateKey: the rateKey tasks were forked with
+      :param rate: tasks a second, 0 for unlimited
+      :param burst: optional number of tasks handed out back to back after
+      the rateKey has been idle. defaults to the queue's --rateBurst
+      """
+
+      self.sharedQueue.setRateLimit(rateKey, rate, burst)
+
+   def getDepth(self):
+      """gets the current depth of the queue this Task forks to, so
+      producers can pace themselves before .forkTask() blocks.
+      :returns: dict of the pipeline length, the tasks held back by their
+      rate limit and by runAt/delay, the approximate store bytes, their
+      high-water marks (0 when unbounded) and whether forking is currently
+      held back (eg, {'pipeline': 10, 'throttled': 0, 'delayed': 0,
+      'highWater': 1000, 'storeBytes': 0, 'highWaterBytes': 0,
+      'pressured': False})
+      """
+
+      return self.sharedQueue.depth()
+
+   def countPending(self, tag= None):
+      """gets the number of subTasks which have not been generated by
+      .as_completed() yet, whether or not they have completed.
+      :param tag: optional tag to filter subTasks by
+      :returns: number of pending subTasks
+      """
+
+      with self.lock:
+         tags= [tag] if tag != None else set(self.outstanding.keys() + self.completed.keys())
+         return sum([self.outstanding.get(tag, 0) + len(self.completed.get(tag, [])) for tag in tags])
+
+   def as_completed(self, tag= None, timeout= None):
+      """generates the results of the subTasks forked by the current instance
+      of Task as they complete.  each completed subTask is generated once,
+      subTasks forked while iterating are included.
+      :param tag: optional tag to filter subTasks by
+      :param timeout: optional timeout in seconds after which the generator
+      stops, even if subTasks are still outstanding
+      :returns: generator of the data store results of each completed
+      subTask (see .getSubTask())
+      """
+
+      if timeout != None:
+         startTime= time()
+         endTime= startTime + timeout
+
+      remaining= None
+      while True:
+
+         with self.lock:
+            tags= [tag] if tag != None else set(self.outstanding.keys() + self.completed.keys())
+
+            subTaskIds= []
+            for completedTag in tags:
+               completed= self.completed.get(completedTag, deque())
+               subTaskIds.extend([completed.popleft() for i in xrange(len(completed))])
+
+            outstanding= sum([self.outstanding.get(outstandingTag, 0) for outstandingTag in tags])
+
+         if subTaskIds:
+
+            # skip subTasks killed since they completed
+            with self.lock:
+               subTaskIds= filter(lambda subTaskId: subTaskId in self.subTasks, subTaskIds)
+
+            generated= 0
+            try:
+               for subTask in self.__getSubTasks__(subTaskIds):
+                  generated+= 1
+                  if subTask:
+                     yield subTask
+            finally:
+               # hand back what was not generated if the caller stopped early
+               with self.lock:
+                  for subTaskId in reversed(subTaskIds[generated:]):
+                     self.completed.setdefault(self.tags.get(subTaskId), deque()).appendleft(subTaskId)
+
+            continue
+
+         if outstanding == 0:
+            break
+
+         if timeout != None:
+            remaining= endTime - time()
+            if remaining <= 0:
+               break
+
+         self.__waitCompletions__(remaining)
+
+   def __waitCompletions__(self, timeout= None):
+      """used internally by Task to block until subTasks complete.  the
+      queue pushes completions, so nothing is polled while no subTasks are
+      finishing.
+      :param timeout: optional timeout in seconds to wait
+      """
+
+      with self.lock:
+         cursor= self.cursor
+
+      (completions, cursor)= self.sharedQueue.waitAny(self.getTaskId(), cursor, timeout)
+
+      with self.lock:
+         for (processId, status) in completions:
+
+            subTaskId= int(processId.split('.')[1])
+            if self.statuses.get(subTaskId) in ('ready', 'error'):
+               continue
+
+            self.statuses[subTaskId]= status
+            if subTaskId in self.tags:
+               tag= self.tags.get(subTaskId)
+               self.outstanding[tag]-= 1
+               self.completed.setdefault(tag, deque()).append(subTaskId)
+
+         self.cursor= max(self.cursor, cursor)
 
    def joinSubTask(self, subTaskId, timeout= None):
       """waits for results in the data store to be available for the given 
@@ -234,23 +568,29 @@ class Task(object):
       :returns: the status of the given subTaskId (eg, 'ready', 'error')
       """
 
-      subtask= self.getSubTask(subTaskId)
-
       if timeout != None:
          startTime= time()
          endTime= startTime + timeout
 
-      while subtask.get('status') not in ('ready', 'error'): 
+      remaining= None
+      while True:
+
+         with self.lock:
+            status= self.statuses.get(subTaskId)
+            if status in ('ready', 'error') or subTaskId not in self.subTasks:
+               break
 
          if timeout != None:
-            currentTime= time()
-            if currentTime >= endTime:
+            remaining= endTime - time()
+            if remaining <= 0:
                break
 
-         sleep(self.sleep)
-         subtask= self.getSubTask(subTaskId)
+         self.__waitCompletions__(remaining)
+
+      if status in ('ready', 'error'):
+         return status
 
-      return subtask.get('status')
+      return self.getSubTask(subTaskId, 'status')
 
    def joinTask(self, timeout= None, tag= None):
       """waits for all subTasks associated with the current instance of
@@ -265,25 +605,42 @@ class Task(object):
          endTime= startTime + timeout
 
       with self.lock:
-         subTasks= deepcopy(self.subTasks)
-      statusList= [self.joinSubTask(subTaskId, 0) for subTaskId in subTasks]
-      if tag != None:
-         statusList= filter(lambda subTask: subTask.get('tag') == tag, statusList)
+         subTaskIds= sorted(filter(lambda subTaskId: tag == None or self.tags.get(subTaskId) == tag, self.subTasks))
+
+      # subTaskIds before index have all completed (or been killed)
+      index= 0
+      remaining= None
+      while True:
 
-      while filter(lambda status: status not in ('ready', 'error'), statusList):
+         with self.lock:
+            while index < len(subTaskIds) and (self.statuses.get(subTaskIds[index]) in ('ready', 'error') or subTaskIds[index] not in self.subTasks):
+               index+= 1
+
+            # pick up any subTasks forked while we were waiting
+            if index == len(subTaskIds):
+               known= set(subTaskIds)
+               subTaskIds.extend(sorted(filter(lambda subTaskId: subTaskId not in known and (tag == None or self.tags.get(subTaskId) == tag), self.subTasks)))
+               if index < len(subTaskIds):
+                  continue
+               break
 
          if timeout != None:
-            currentTime= time()
-            if currentTime >= endTime:
+            remaining= endTime - time()
+            if remaining <= 0:
                break
-    
-         sleep(self.sleep)
- 
-         with self.lock:
-            subTasks= deepcopy(self.subTasks)
-         statusList= [self.joinSubTask(subTaskId, 0) for subTaskId in subTasks]
-         if tag != None:
-            statusList= filter(lambda subTask: subTask.get('tag') == tag, statusList)
+
+         self.__waitCompletions__(remaining)
+
+      with self.lock:
+         subTaskIds= filter(lambda subTaskId: subTaskId in self.subTasks, subTaskIds)
+         statusList= [self.statuses.get(subTaskId) for subTaskId in subTaskIds]
+
+      # on timeout fetch the status of anything still outstanding in one call
+      pending= [i for (i, status) in enumerate(statusList) if status not in ('ready', 'error')]
+      if pending:
+         statuses= self.sharedQueue.getStatuses([self.__genProcessId__(subTaskIds[i]) for i in pending])
+         for (i, status) in zip(pending, statuses):
+            statusList[i]= status
 
       return statusList
 
@@ -297,10 +654,7 @@ class Task(object):
 
       self.joinSubTask(subTaskId)
 
-      try:
-         subtask= self.store.pop(processId)
-      except KeyError:
-         subtask= None
+      subtask= self.sharedQueue.pop(processId)
 
       if subtask == None:
          raise Exception('could not find task store: %s' % (processId))
@@ -312,6 +666,8 @@ class Task(object):
       try:
             with self.lock:
                subTask= self.subTasks.pop(subTaskId)
+               self.tags.pop(subTaskId, None)
+               self.statuses.pop(subTaskId, None)
       except KeyError:
          raise Exception("unkown subtask: %s" % (processId))
 
@@ -324,11 +680,14 @@ class Task(object):
       :returns: list of subTaskIds killed by this operation
       """
 
-      #with self.lock:
-      subTasks= deepcopy(self.subTasks)
+      with self.lock:
+         subTasks= filter(lambda subTaskId: tag == None or self.tags.get(subTaskId) == tag, self.subTasks)
       subTasks= [self.killSubTask(subTaskId) for subTaskId in subTasks]
-      if tag != None:
-         subTasks= filter(lambda subTask: subTask.get('tag') == tag, subTasks)
+
+      if tag == None:
+         self.sharedQueue.clearCompletions(self.getTaskId())
+         with self.lock:
+            self.completed.clear()
 
       return subTasks
 